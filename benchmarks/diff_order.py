@@ -0,0 +1,68 @@
+"""
+Compare the old SequenceMatcher-based diff_order against the one based on
+a longest increasing subsequence.
+
+Run from the repository root:
+
+    python -m benchmarks.diff_order [--items N]
+"""
+import random
+from argparse import ArgumentParser
+from difflib import SequenceMatcher
+from time import time
+
+from lgtd.lib.util import diff_order, patch_order
+
+
+def diff_order_matcher(a, b):
+    """
+    The original implementation.
+    """
+    return [
+        [None if start == 0 else b[start - 1]] + list(b[start:end])
+        for tag, _, _, start, end in SequenceMatcher(None, a, b).get_opcodes()
+        if tag in ('insert', 'replace')
+    ]
+
+
+def drag(items, moves):
+    b = list(items)
+    for _ in xrange(moves):
+        b.insert(random.randrange(len(b)), b.pop(random.randrange(len(b))))
+    return b
+
+
+def shuffled(items):
+    b = list(items)
+    random.shuffle(b)
+    return b
+
+
+def measure(name, f, a, b):
+    start = time()
+    diff = f(a, b)
+    duration = time() - start
+    assert patch_order(a, diff) == b
+
+    print('{:>12}: {:8.3f} s  {:6} diffs  {:6} moved'.format(
+        name, duration, len(diff), sum(len(d) - 1 for d in diff)))
+
+
+def run():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--items', type=int, default=10000)
+    args = parser.parse_args()
+
+    a = ['{:05x}'.format(i) for i in xrange(args.items)]
+    for scenario, b in [
+            ('one drag', drag(a, 1)),
+            ('ten drags', drag(a, 10)),
+            ('reversed', a[::-1]),
+            ('shuffled', shuffled(a))]:
+        print('{} ({} items)'.format(scenario, args.items))
+        measure('matcher', diff_order_matcher, a, b)
+        measure('lis', diff_order, a, b)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,123 @@
+"""
+Measure a burst of single command pushes, appended one by one and grouped
+by the CommandBatcher of the local daemon. Changes are picked up the way
+the daemon does it, by watching the data directory.
+
+Run from the repository root:
+
+    python -m benchmarks.push_commands [--pushes N] [--clients C]
+"""
+import os
+import time
+from argparse import ArgumentParser
+from datetime import timedelta
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import pyinotify
+from tornado import ioloop
+
+from lgtd.lib.crypto import CommandCipher
+from lgtd.lib.db.client import Database
+from lgtd.provider.daemon import (CommandBatcher, LogEvents, StateManager,
+                                  change_callback)
+
+
+def measure(name, make_push, args):
+    tmp_dir = mkdtemp()
+    data_dir = os.path.join(tmp_dir, 'data')
+    lock_file = os.path.join(tmp_dir, 'lock')
+    generation_file = os.path.join(tmp_dir, 'generation')
+    os.mkdir(data_dir)
+    open(lock_file, 'w').close()
+    open(generation_file, 'w').close()
+
+    state_manager = StateManager(
+        'ab', Database(data_dir, lock_file, generation_file),
+        CommandCipher('k' * 32))
+    loop = ioloop.IOLoop()
+    loop.make_current()
+
+    # what setup_server() of the daemon does
+    wm = pyinotify.WatchManager()
+    log_events = LogEvents()
+    notifier = pyinotify.TornadoAsyncNotifier(
+        wm, loop, change_callback, log_events)
+    notifier.clients = []
+    notifier.state_manager = state_manager
+    notifier.log_events = log_events
+    notifier.scheduled = False
+    wm.add_watch(
+        data_dir,
+        pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO)
+
+    notifications = [0]
+    notify = state_manager.notify
+
+    def count(app_ids=None):
+        changed = notify(app_ids)
+        notifications[0] += changed
+        return changed
+    state_manager.notify = count
+
+    def burst():
+        for i in xrange(args.pushes):
+            # as if every client sent a message per IOLoop iteration
+            if i % args.clients == 0:
+                yield
+            yield u't {:06x} title of item {}'.format(i, i)
+
+    log = os.path.join(data_dir, 'ab')
+    commands = burst()
+    push = make_push(loop, state_manager)
+
+    def receive():
+        for command in commands:
+            if command is None:
+                loop.add_callback(receive)
+                return
+            push([command])
+
+        wait_applied()
+
+    def wait_applied():
+        if os.path.exists(log) and \
+                state_manager.offsets['ab'] == os.path.getsize(log):
+            loop.stop()
+        else:
+            loop.add_timeout(timedelta(milliseconds=1), wait_applied)
+
+    start = time.time()
+    loop.add_callback(receive)
+    loop.start()
+    duration = time.time() - start
+
+    notifier.stop()
+    ioloop.IOLoop.clear_current()
+    loop.close()
+    rmtree(tmp_dir)
+
+    print('{:>10}: {:8.3f} s  {:8.0f} pushes/s  {:6} notifications'.format(
+        name, duration, args.pushes / duration, notifications[0]))
+
+
+def push_each(loop, state_manager):
+    return state_manager.push_commands
+
+
+def push_batched(loop, state_manager):
+    return CommandBatcher(state_manager, loop).push
+
+
+def run():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--pushes', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=4)
+    args = parser.parse_args()
+
+    measure('each', push_each, args)
+    measure('batched', push_batched, args)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,110 @@
+"""
+Compare the old sort-based Database.read_all merge against the heap-based one.
+
+Run from the repository root:
+
+    python -m benchmarks.read_all [--commands N] [--app-ids K]
+"""
+import os
+import random
+from argparse import ArgumentParser
+from collections import defaultdict
+from shutil import rmtree
+from struct import pack
+from tempfile import mkdtemp
+from time import time
+
+from lgtd.lib.crypto import CommandCipher
+from lgtd.lib.db.client import Database
+
+# looks like a real line, the merge never decrypts anything
+PAYLOAD = ' {} {}\n'.format('t' * 22, 'c' * 32)
+
+
+def write_logs(data_dir, num_commands, num_app_ids):
+    app_ids = ['{:02d}'.format(i) for i in xrange(num_app_ids)]
+    start = 1450000000 * 1000
+
+    for app_id in app_ids:
+        t = start
+        lines = []
+        for _ in xrange(num_commands // num_app_ids):
+            t += random.randint(0, 60000)
+            sec, msec = divmod(t, 1000)
+            iv = pack('>Q', ((sec << 28) | (msec << 18)) << 4)
+            lines.append(CommandCipher.encode_iv(iv) + PAYLOAD)
+
+        with open(os.path.join(data_dir, app_id), 'w') as f:
+            f.write(''.join(lines))
+
+
+def read_all_sorted(db, start_offs):
+    """
+    The original implementation, re-sorting all heads on every line.
+    """
+    def read_line(f):
+        offset = f.tell()
+        line = f.readline()
+        if not line:
+            f.close()
+            return None
+        else:
+            return (CommandCipher.extract_time(line), line, f, offset)
+
+    lines = []
+    for app_id in os.listdir(db.data_path):
+        f = open(os.path.join(db.data_path, app_id), 'r')
+        f.seek(start_offs[app_id])
+        line = read_line(f)
+        if line:
+            lines.append(line + (app_id, ))
+
+    while lines:
+        lines.sort()
+        (_, line, f, offset, app_id) = lines[0]
+        yield line, app_id, offset
+        del lines[0]
+
+        line = read_line(f)
+        if line:
+            lines.insert(0, line + (app_id, ))
+
+
+def measure(name, lines):
+    start = time()
+    count = 0
+    last = 0
+    for line, _, _ in lines:
+        t = CommandCipher.extract_time(line)
+        assert t >= last
+        last = t
+        count += 1
+
+    duration = time() - start
+    print('{:>8}: {:8.2f} s  {:10.0f} lines/s'.format(
+        name, duration, count / duration))
+    return count
+
+
+def run():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--commands', type=int, default=1000000)
+    parser.add_argument('--app-ids', type=int, default=50)
+    args = parser.parse_args()
+
+    data_dir = mkdtemp()
+    try:
+        print('writing {} commands across {} app_ids...'.format(
+            args.commands, args.app_ids))
+        write_logs(data_dir, args.commands, args.app_ids)
+
+        db = Database(data_dir)
+        old = measure('sort', read_all_sorted(db, defaultdict(int)))
+        new = measure('heap', db.read_all(defaultdict(int)))
+        assert old == new
+    finally:
+        rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,67 @@
+"""
+Measure a full replay of the local daemon with and without the checkpoints
+taken for late commands.
+
+Run from the repository root:
+
+    python -m benchmarks.replay_checkpoints [--commands N]
+"""
+import os
+import time
+from argparse import ArgumentParser
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from lgtd.lib.crypto import CommandCipher
+from lgtd.lib.db.client import Database
+from lgtd.provider import daemon
+
+
+def make_state_manager(data_dir, lock_file):
+    return daemon.StateManager(
+        'ab', Database(data_dir, lock_file), CommandCipher('k' * 32))
+
+
+def write_log(data_dir, lock_file, num_commands):
+    sm = make_state_manager(data_dir, lock_file)
+    for start in xrange(0, num_commands, 1000):
+        sm.push_commands([
+            u't {:06x} title of item {}'.format(i, i)
+            for i in xrange(start, min(start + 1000, num_commands))])
+
+
+def measure(name, data_dir, lock_file, args):
+    sm = make_state_manager(data_dir, lock_file)
+    start = time.time()
+    sm.notify()
+    duration = time.time() - start
+
+    print('{:>15}: {:8.2f} s  {:8.0f} commands/s  {:3} checkpoints'.format(
+        name, duration, args.commands / duration, len(sm.checkpoints)))
+
+
+def run():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--commands', type=int, default=50000)
+    args = parser.parse_args()
+
+    tmp_dir = mkdtemp()
+    data_dir = os.path.join(tmp_dir, 'data')
+    lock_file = os.path.join(tmp_dir, 'lock')
+    os.mkdir(data_dir)
+    open(lock_file, 'w').close()
+
+    try:
+        write_log(data_dir, lock_file, args.commands)
+
+        interval = daemon.CHECKPOINT_INTERVAL
+        daemon.CHECKPOINT_INTERVAL = args.commands + 1
+        measure('no checkpoints', data_dir, lock_file, args)
+        daemon.CHECKPOINT_INTERVAL = interval
+        measure('checkpoints', data_dir, lock_file, args)
+    finally:
+        rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,63 @@
+"""
+Compare the memory footprint of the replayed state with plain dict items
+against compact Item records.
+
+Run from the repository root:
+
+    python -m benchmarks.state_memory [--items N] [--tags K]
+"""
+import os
+import random
+from argparse import ArgumentParser
+from collections import OrderedDict
+from resource import RUSAGE_SELF, getrusage
+
+from lgtd.lib.state import Item
+
+
+def make_dict_item(title, tag):
+    return {'title': title, 'tag': tag}
+
+
+def make_commands(num_items, num_tags):
+    tags = ['tag{}'.format(i) for i in xrange(num_tags)]
+    for i in xrange(num_items):
+        # tags come out of Command.parse() as fresh strings every time
+        yield ('{:06x}'.format(i), 'title of item {}'.format(i),
+               ''.join(random.choice(tags)))
+
+
+def measure(name, make_item, commands):
+    """
+    Build the state in a child process and report its growth in max RSS.
+    """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    before = getrusage(RUSAGE_SELF).ru_maxrss
+    items = OrderedDict()
+    for item_id, title, tag in commands:
+        items[item_id] = make_item(title, tag)
+    after = getrusage(RUSAGE_SELF).ru_maxrss
+
+    print('{:>8}: {:8.1f} MiB'.format(name, (after - before) / 1024.0))
+    os._exit(0)
+
+
+def run():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--items', type=int, default=500000)
+    parser.add_argument('--tags', type=int, default=50)
+    args = parser.parse_args()
+
+    print('building {} items with {} tags...'.format(args.items, args.tags))
+    commands = list(make_commands(args.items, args.tags))
+
+    measure('dict', make_dict_item, commands)
+    measure('Item', Item, commands)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,125 @@
+"""
+Load test the sync server with concurrent simulated clients, once with disk
+I/O on the IOLoop thread and once on a thread pool.
+
+Run from the repository root:
+
+    python -m benchmarks.sync_server [--users N] [--clients C]
+        [--requests R] [--io-threads T] [--disk-latency MS]
+
+--disk-latency adds a sleep to every disk access to stand in for a slow or
+busy disk, which is where the thread pool pays off.
+"""
+import os
+import random
+import time
+from argparse import ArgumentParser, Namespace
+from json import dumps
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from tornado import gen, httpserver, ioloop, netutil
+from tornado.httpclient import AsyncHTTPClient
+
+from lgtd.lib.db.syncable import Database
+from lgtd.sync.server import make_app
+
+
+def slow_down(latency):
+    """
+    Make every disk access of the sync database take at least latency
+    seconds longer.
+    """
+    def wrap(f):
+        def slow(*args, **kwargs):
+            time.sleep(latency)
+            return f(*args, **kwargs)
+        return slow
+
+    for name in ('get_offsets', '_get_data', '_put_data'):
+        setattr(Database, name, wrap(getattr(Database, name)))
+
+
+def write_users(data_dir, num_users):
+    tokens = ['user{:06d}'.format(i) for i in xrange(num_users)]
+    for token in tokens:
+        os.mkdir(os.path.join(data_dir, token))
+        for app_id in ('aa', 'bb', 'cc'):
+            with open(os.path.join(data_dir, token, app_id), 'w') as f:
+                f.write(('x' * 80 + '\n') * 1000)
+
+    return tokens
+
+
+@gen.coroutine
+def simulate_client(port, tokens, num_requests):
+    client = AsyncHTTPClient()
+    for i in xrange(num_requests):
+        token = random.choice(tokens)
+        if i % 4:
+            body = dumps({'offs': {'aa': 0}})
+            op = 'pull'
+        else:
+            # appending to a random app_id might collide, which is a 400
+            body = dumps({'data': {'dd': [0, 'y' * 80 + '\n']}})
+            op = 'push'
+
+        yield client.fetch(
+            'http://127.0.0.1:{}/gtd/{}/{}'.format(port, token, op),
+            method='POST', body=body, raise_error=False)
+
+
+def measure(data_dir, io_threads, args):
+    loop = ioloop.IOLoop()
+    loop.make_current()
+    AsyncHTTPClient.configure(None, max_clients=args.clients)
+
+    tokens = write_users(data_dir, args.users)
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server = httpserver.HTTPServer(make_app(Namespace(
+        data_dir=data_dir, io_threads=io_threads)))
+    server.add_sockets(sockets)
+
+    @gen.coroutine
+    def load():
+        yield [
+            simulate_client(port, tokens, args.requests)
+            for _ in xrange(args.clients)]
+
+    start = time.time()
+    loop.run_sync(load)
+    duration = time.time() - start
+
+    server.stop()
+    loop.close(all_fds=True)
+    for token in tokens:
+        rmtree(os.path.join(data_dir, token))
+
+    total = args.clients * args.requests
+    print('{:>10} io threads: {:8.2f} s  {:8.0f} requests/s'.format(
+        io_threads, duration, total / duration))
+
+
+def run():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--io-threads', type=int, default=4)
+    parser.add_argument('--disk-latency', type=float, default=5)
+    args = parser.parse_args()
+
+    if args.disk_latency:
+        slow_down(args.disk_latency / 1000.0)
+
+    data_dir = mkdtemp()
+    try:
+        measure(data_dir, 0, args)
+        measure(data_dir, args.io_threads, args)
+    finally:
+        rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    run()
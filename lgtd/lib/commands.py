@@ -1,6 +1,7 @@
 from collections import OrderedDict
 from itertools import chain
 
+from .state import Item
 from .util import patch_order
 
 
@@ -99,6 +100,9 @@ class OrderItemsCommand(Command):
         for num in nums:
             state['items'][num] = old_items[num]
 
+        if 'index' in state:
+            state['index'].reorder(nums)
+
 
 @CommandRegistry.register
 class ItemTitleCommand(Command):
@@ -107,9 +111,12 @@ class ItemTitleCommand(Command):
 
     def apply(self, state):
         if self.item_id not in state['items']:
-            state['items'][self.item_id] = {'tag': ''}
+            state['items'][self.item_id] = Item()
+            state['tag_order'].ref('')
+            if 'index' in state:
+                state['index'].add(self.item_id, '')
 
-        state['items'][self.item_id]['title'] = self.title
+        state['items'][self.item_id].title = self.title
 
 
 @CommandRegistry.register
@@ -119,9 +126,13 @@ class DeleteItemCommand(Command):
 
     def apply(self, state):
         try:
-            del state['items'][self.item_id]
+            item = state['items'].pop(self.item_id)
         except KeyError:
             pass
+        else:
+            state['tag_order'].unref(item.tag)
+            if 'index' in state:
+                state['index'].remove(self.item_id, item.tag)
 
 
 @CommandRegistry.register
@@ -134,13 +145,19 @@ class SetTagCommand(Command):
             return
 
         try:
-            state['items'][self.item_id]['tag'] = self.tag
+            item = state['items'][self.item_id]
         except KeyError:
             pass
         else:
-            if (self.tag not in state['tag_order'] and
-                    not self.tag.startswith('$')):
-                state['tag_order'].append(self.tag)
+            tag = intern(self.tag)
+            order = state['tag_order']
+            order.unref(item.tag)
+            order.ref(tag)
+            if 'index' in state:
+                state['index'].retag(self.item_id, item.tag, tag)
+            item.tag = tag
+            if tag not in order and not tag.startswith('$'):
+                order.append(tag)
 
 
 @CommandRegistry.register
@@ -150,9 +167,15 @@ class UnsetTagCommand(Command):
 
     def apply(self, state):
         try:
-            state['items'][self.item_id]['tag'] = ''
+            item = state['items'][self.item_id]
         except KeyError:
             pass
+        else:
+            state['tag_order'].unref(item.tag)
+            state['tag_order'].ref('')
+            if 'index' in state:
+                state['index'].retag(self.item_id, item.tag, '')
+            item.tag = ''
 
 
 @CommandRegistry.register
@@ -165,8 +188,7 @@ class OrderTagCommand(Command):
         if self.first not in order or self.second not in order:
             return
 
-        order.remove(self.second)
-        order.insert(order.index(self.first) + 1, self.second)
+        order.move_after(self.first, self.second)
 
 
 @CommandRegistry.register
@@ -175,13 +197,12 @@ class DeleteTagCommand(Command):
     args = ['tag']
 
     def apply(self, state):
-        if self.tag not in state['tag_order']:
+        order = state['tag_order']
+        if self.tag not in order:
             return
         if self.tag in ('inbox', 'tickler'):
             return
+        if not order.is_empty(self.tag):
+            return  # don't remove non-empty tags
 
-        for item in state['items'].values():
-            if item['tag'] == self.tag:
-                return  # don't remove non-empty tags
-
-        state['tag_order'].remove(self.tag)
+        order.remove(self.tag)
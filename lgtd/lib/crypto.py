@@ -1,12 +1,33 @@
 import os
 from base64 import b64decode, b64encode
+from binascii import a2b_base64
 from calendar import timegm
+from collections import deque
 from datetime import datetime
 from hashlib import sha256
+from itertools import islice
+from multiprocessing import Pool
 from struct import pack, unpack
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+# number of commands handed to a worker process at once
+PARALLEL_CHUNK_SIZE = 2000
+
+# cipher of the current worker process, see decrypt_parallel()
+_worker_cipher = None
+
+
+def _init_worker(key):
+    global _worker_cipher
+    _worker_cipher = CommandCipher(key)
+
+
+def _decrypt_chunk(args):
+    chunk, strict = args
+    return list(_worker_cipher.decrypt_many(chunk, strict))
 
 
 def hash_password(password):
@@ -22,8 +43,12 @@ def hash_password(password):
 
 
 class CommandCipher(object):
+    TAG_LEN = 16
+
     def __init__(self, key):
         self.key = key
+        # holds the expanded key, reused for every command
+        self.aead = AESGCM(key)
 
     @staticmethod
     def generate_iv():
@@ -84,19 +109,13 @@ class CommandCipher(object):
 
     def encrypt(self, plaintext, client_id, offset):
         iv = self.generate_iv()
-        encryptor = Cipher(
-            algorithms.AES(self.key),
-            modes.GCM(iv),
-            backend=default_backend()
-        ).encryptor()
-
-        encryptor.authenticate_additional_data(
-            self.format_auth_data(client_id, offset))
-        ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+        sealed = self.aead.encrypt(
+            iv, plaintext, self.format_auth_data(client_id, offset))
+        ciphertext, tag = sealed[:-self.TAG_LEN], sealed[-self.TAG_LEN:]
 
         return '{} {} {}\n'.format(
             self.encode_iv(iv),
-            self.unpadded(b64encode(encryptor.tag)),
+            self.unpadded(b64encode(tag)),
             self.unpadded(b64encode(ciphertext)),
         )
 
@@ -106,13 +125,66 @@ class CommandCipher(object):
         tag = b64decode(self.padded(tag))
         ciphertext = b64decode(self.padded(ciphertext))
 
-        decryptor = Cipher(
-            algorithms.AES(self.key),
-            modes.GCM(iv, tag),
-            backend=default_backend()
-        ).decryptor()
-
-        decryptor.authenticate_additional_data(
-            self.format_auth_data(client_id, offset))
-
-        return decryptor.update(ciphertext) + decryptor.finalize()
+        return self.aead.decrypt(
+            iv, ciphertext + tag, self.format_auth_data(client_id, offset))
+
+    def decrypt_many(self, records, strict=True):
+        """
+        Decrypt an iterable of (ciphertext, client_id, offset) and yield the
+        plaintexts in the same order. If strict is false, yield None for
+        records that fail to authenticate instead of raising InvalidTag.
+        """
+        decrypt = self.aead.decrypt
+        decode_iv = self.decode_iv
+        padded = self.padded
+        auth_data = self.format_auth_data
+
+        for line, client_id, offset in records:
+            iv, tag, ciphertext = line.split(' ')
+            try:
+                yield decrypt(
+                    decode_iv(iv),
+                    a2b_base64(padded(ciphertext.rstrip())) +
+                    a2b_base64(padded(tag)),
+                    auth_data(client_id, offset))
+            except InvalidTag:
+                if strict:
+                    raise
+                yield None
+
+    def decrypt_parallel(self, records, jobs, strict=True,
+                         chunk_size=PARALLEL_CHUNK_SIZE):
+        """
+        Like decrypt_many() but spread the work across jobs processes.
+        Records are decrypted in chunks and the plaintexts are yielded in
+        input order, i.e. in IV time order for the output of read_all().
+        Only a few chunks per process are in flight at any time.
+        """
+        if jobs <= 1:
+            for plaintext in self.decrypt_many(records, strict):
+                yield plaintext
+            return
+
+        records = iter(records)
+        pool = Pool(jobs, _init_worker, (self.key, ))
+        pending = deque()
+
+        def submit():
+            chunk = list(islice(records, chunk_size))
+            if chunk:
+                pending.append(
+                    pool.apply_async(_decrypt_chunk, ((chunk, strict), )))
+            return bool(chunk)
+
+        try:
+            while len(pending) < 2 * jobs and submit():
+                pass
+
+            while pending:
+                plaintexts = pending.popleft().get()
+                submit()
+                for plaintext in plaintexts:
+                    yield plaintext
+        finally:
+            pool.terminate()
+            pool.join()
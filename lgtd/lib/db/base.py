@@ -1,21 +1,56 @@
 import os
 from collections import defaultdict
 from contextlib import contextmanager
-from fcntl import LOCK_EX, LOCK_UN, flock
+from fcntl import LOCK_EX, LOCK_SH, LOCK_UN, flock
+
+# coarsest mtime granularity we expect (FAT), a directory modified within
+# that long before listing may change again without its mtime changing
+MTIME_GRANULARITY = 2
 
 
 class BaseDatabase(object):
-    def __init__(self, data_path, lock_path=None):
+    def __init__(self, data_path, lock_path=None, generation_path=None):
         self.data_path = data_path
         self.lock_path = lock_path
+        self.generation_path = generation_path
 
     @contextmanager
     def lock(self, read_only=False):
+        """
+        Readers share the lock, writers hold it exclusively and bump the
+        generation before releasing it. Watchers of the generation file
+        learn about changes that way, readers never wake them up.
+        """
         mode = 'r' if read_only else 'a'
         with open(self.lock_path, mode) as f:
-            flock(f, LOCK_EX)
-            yield
-            flock(f, LOCK_UN)
+            flock(f, LOCK_SH if read_only else LOCK_EX)
+            try:
+                yield
+            finally:
+                if not read_only:
+                    self._bump_generation()
+                flock(f, LOCK_UN)
+
+    def get_generation(self):
+        """
+        Return the number of write locks released so far.
+        """
+        if not self.generation_path:
+            return 0
+
+        try:
+            with open(self.generation_path) as f:
+                return int(f.read() or 0)
+        except IOError:
+            return 0
+
+    def _bump_generation(self):
+        if not self.generation_path:
+            return
+
+        generation = self.get_generation() + 1
+        with open(self.generation_path, 'w') as f:
+            f.write('{}\n'.format(generation))
 
     def get_offsets(self):
         app_ids = os.listdir(self.data_path)
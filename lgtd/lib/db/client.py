@@ -1,23 +1,121 @@
+import errno
 import os
+import time
+from collections import defaultdict
 from contextlib import contextmanager
+from heapq import heapify, heappop, heapreplace
+from mmap import ACCESS_READ, mmap
 
 from ..crypto import CommandCipher
-from .base import BaseDatabase
+from .base import MTIME_GRANULARITY, BaseDatabase
 
 
 class Database(BaseDatabase):
     """
-    Database interface for actual data access.
+    Database interface for actual data access. Logs are kept open once
+    seen, so that following them costs an fstat per log and the data
+    directory is only listed again when its mtime says a log was added.
+    Logs replaced by a rename are opened again and their app_ids added to
+    replaced, their content cannot be followed from the old offsets.
     """
-    @staticmethod
-    def _read_line(f):
-        offset = f.tell()
-        line = f.readline()
-        if not line:
+    def __init__(self, *args, **kwargs):
+        super(Database, self).__init__(*args, **kwargs)
+        self.files = {}
+        # last known sizes of the open logs
+        self.sizes = {}
+        self.listed_mtime = None
+        self.replaced = set()
+
+    def close(self):
+        for f in self.files.itervalues():
             f.close()
+        self.files.clear()
+        self.sizes.clear()
+        self.listed_mtime = None
+        self.replaced.clear()
+
+    def _list(self):
+        # before listing so that logs added meanwhile change it again
+        mtime = os.stat(self.data_path).st_mtime
+        if mtime == self.listed_mtime:
+            return
+
+        app_ids = set(os.listdir(self.data_path))
+        for app_id in set(self.files) - app_ids:
+            self.files.pop(app_id).close()
+            self.sizes.pop(app_id, None)
+        for app_id in app_ids:
+            self._open(app_id)
+
+        # logs added within the same tick would not change the mtime
+        if time.time() - mtime > MTIME_GRANULARITY:
+            self.listed_mtime = mtime
+        else:
+            self.listed_mtime = None
+
+    def _open(self, app_id):
+        """
+        Open the log app_id unless the same file is open already. Returns
+        false if it does not exist.
+        """
+        path = os.path.join(self.data_path, app_id)
+        try:
+            inode = os.stat(path).st_ino
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+        f = self.files.get(app_id)
+        if f is not None:
+            if os.fstat(f.fileno()).st_ino == inode:
+                return True
+            f.close()
+            self.sizes.pop(app_id, None)
+            self.replaced.add(app_id)
+
+        self.files[app_id] = open(path, 'rb')
+        return True
+
+    def get_offsets(self, app_ids=None):
+        """
+        Return the sizes of all logs. With app_ids, only those and newly
+        added logs are looked at, the rest keep their last known size.
+        Logs in app_ids are opened if the listing missed them.
+        """
+        self._list()
+        if app_ids is None:
+            app_ids = self.files
+        else:
+            app_ids = set(filter(self._open, app_ids)).union(
+                set(self.files) - set(self.sizes))
+
+        for app_id in app_ids:
+            self.sizes[app_id] = os.fstat(self.files[app_id].fileno()).st_size
+
+        return defaultdict(int, self.sizes)
+
+    @staticmethod
+    def _map(f, offset):
+        """
+        Return a read-only mapping of the open file f, or None if there is
+        nothing after offset.
+        """
+        if os.fstat(f.fileno()).st_size <= offset:
+            return None
+        return mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    @staticmethod
+    def _read_line(mm, app_id, offset):
+        if offset >= len(mm):
+            mm.close()
             return None
         else:
-            return (CommandCipher.extract_time(line), line, f, offset)
+            end = mm.find('\n', offset) + 1 or len(mm)
+            # app_id and offset break ties between equal times so that
+            # the order is stable and mm itself is never compared
+            return (CommandCipher.extract_time(mm[offset:offset + 10]),
+                    app_id, offset, end, mm)
 
     @contextmanager
     def append(self, app_id):
@@ -26,23 +124,39 @@ class Database(BaseDatabase):
         with open(path, 'ab') as f:
             yield f
 
-    def read_all(self, start_offs):
-        lines = []
+    def read_all(self, start_offs, app_ids=None):
+        """
+        Yield (line, app_id, offset) for all lines after start_offs, merged
+        across all app_ids in IV time order. With app_ids, only those logs
+        are read, e.g. the ones that grew, and ones that do not exist are
+        skipped.
+        """
+        heads = []
+        self._list()
 
         # read first line from each file
-        for app_id in os.listdir(self.data_path):
-            f = open(os.path.join(self.data_path, app_id), 'r')
-            f.seek(start_offs[app_id])
-            line = self._read_line(f)
-            if line:
-                lines.append(line + (app_id, ))
-
-        while lines:
-            lines.sort()
-            (_, line, f, offset, app_id) = lines[0]
-            yield line, app_id, offset
-            del lines[0]
-
-            line = self._read_line(f)
-            if line:
-                lines.insert(0, line + (app_id, ))
+        if app_ids is None:
+            app_ids = self.files
+        else:
+            app_ids = filter(self._open, app_ids)
+
+        for app_id in app_ids:
+            mm = self._map(self.files[app_id], start_offs[app_id])
+            if mm:
+                heads.append(self._read_line(mm, app_id, start_offs[app_id]))
+
+        heapify(heads)
+
+        try:
+            while heads:
+                _, app_id, offset, end, mm = heads[0]
+                yield mm[offset:end], app_id, offset
+
+                head = self._read_line(mm, app_id, end)
+                if head:
+                    heapreplace(heads, head)
+                else:
+                    heappop(heads)
+        finally:
+            for _, _, _, _, mm in heads:
+                mm.close()
@@ -1,4 +1,5 @@
 import os
+from mmap import ACCESS_READ, mmap
 
 from .base import BaseDatabase
 
@@ -7,10 +8,26 @@ class Database(BaseDatabase):
     """
     Database interface for sync logic.
     """
-    def _get_data(self, app_id, offset):
+    def _get_data(self, app_id, offset, limit=None, stop=None):
+        """
+        Return the data after offset, up to stop if given. With a limit,
+        return at most that many bytes but always end on a complete line,
+        unless the first line alone exceeds the limit.
+        """
         with open(os.path.join(self.data_path, app_id), 'rb') as f:
-            f.seek(offset)
-            return f.read()
+            if os.fstat(f.fileno()).st_size <= offset:
+                return ''
+
+            # slice the tail straight out of the page cache
+            mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+            try:
+                end = len(mm) if stop is None else min(len(mm), stop)
+                if limit is not None and offset + limit < end:
+                    end = mm.rfind('\n', offset, offset + limit) + 1 or \
+                        mm.find('\n', offset + limit, end) + 1 or end
+                return mm[offset:end]
+            finally:
+                mm.close()
 
     def _put_data(self, app_id, offset, data):
         path = os.path.join(self.data_path, app_id)
@@ -20,22 +37,44 @@ class Database(BaseDatabase):
             f.seek(offset)
             f.write(data)
 
-    def get_missing_data(self, local_offs, remote_offs):
-        data = {}
-
-        for app_id, local_off in local_offs.iteritems():
+    def iter_missing_data(self, local_offs, remote_offs, limit=None):
+        """
+        Yield (app_id, remote_off, data) for every app_id that the remote
+        side is missing data of, up to the local offsets. With a limit, stop
+        after about that many bytes (see _get_data()), in which case later
+        calls with the updated remote offsets return the rest.
+        """
+        for app_id, local_off in sorted(local_offs.iteritems()):
             remote_off = remote_offs[app_id]
             if local_off > remote_off:
-                missing_data = self._get_data(app_id, remote_off)
-                data[app_id] = [remote_off, missing_data]
+                if limit is not None and limit <= 0:
+                    return
 
-        return data
+                missing_data = self._get_data(
+                    app_id, remote_off, limit, local_off)
+                if limit is not None:
+                    limit -= len(missing_data)
+                yield app_id, remote_off, missing_data
+
+    def get_missing_data(self, local_offs, remote_offs, limit=None):
+        return dict(
+            (app_id, [remote_off, missing_data])
+            for app_id, remote_off, missing_data in self.iter_missing_data(
+                local_offs, remote_offs, limit))
 
     def insert_data(self, local_offs, remote_data):
+        """
+        Append the part of remote_data that is not present yet and return
+        the updated offsets.
+        """
+        offs = local_offs.copy()
         for app_id, (remote_off, data) in remote_data.iteritems():
             local_off = local_offs[app_id]
             overlap = local_off - remote_off
             self._put_data(app_id, local_off, data[overlap:])
+            offs[app_id] = local_off + len(data[overlap:])
+
+        return offs
 
     @staticmethod
     def is_gapless(local_offs, remote_data):
@@ -1,6 +1,13 @@
+import os
 import unittest
 from collections import defaultdict
+from fcntl import LOCK_EX, LOCK_NB, LOCK_SH, flock
+from shutil import rmtree
+from struct import pack
+from tempfile import mkdtemp
 
+from ...crypto import CommandCipher
+from ..client import Database as ClientDatabase
 from ..syncable import Database
 
 
@@ -30,3 +37,227 @@ class ServerTestCase(unittest.TestCase):
             'Qi': [4880, 'foo'],
         })
         self.assertFalse(Database.is_gapless(local_offs, remote_data))
+
+
+def make_line(sec, msec, payload):
+    iv = pack('>Q', ((sec << 28) | (msec << 18)) << 4)
+    return '{} {}\n'.format(CommandCipher.encode_iv(iv), payload)
+
+
+class LogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.data_dir)
+
+    def write_log(self, app_id, lines):
+        with open(os.path.join(self.data_dir, app_id), 'w') as f:
+            f.write(''.join(lines))
+
+
+class ClientTestCase(LogTestCase):
+    def test_read_all(self):
+        self.write_log('ab', [
+            make_line(100, 0, 'a0'),
+            make_line(102, 0, 'a1'),
+            make_line(102, 0, 'a2'),
+        ])
+        self.write_log('Qi', [
+            make_line(101, 0, 'q0'),
+            make_line(102, 0, 'q1'),
+            make_line(103, 999, 'q2'),
+        ])
+        self.write_log('9p', [])
+
+        db = ClientDatabase(self.data_dir)
+        payloads = [
+            line.split(' ')[1].strip()
+            for line, _, _ in db.read_all(defaultdict(int))
+        ]
+        # equal times are ordered by app_id, then offset
+        self.assertEqual(payloads, ['a0', 'q0', 'q1', 'a1', 'a2', 'q2'])
+
+        lines = list(db.read_all(defaultdict(int, {'ab': 14, 'Qi': 28})))
+        self.assertEqual(
+            [(app_id, offset) for _, app_id, offset in lines],
+            [('ab', 14), ('ab', 28), ('Qi', 28)])
+
+    def test_read_all_partial_line(self):
+        self.write_log('ab', [make_line(100, 0, 'a0'), 'VqdrlN+V/3 a1'])
+
+        db = ClientDatabase(self.data_dir)
+        lines = list(db.read_all(defaultdict(int)))
+        self.assertEqual([line for line, _, _ in lines], [
+            make_line(100, 0, 'a0'), 'VqdrlN+V/3 a1'])
+        self.assertEqual(list(db.read_all(defaultdict(int, {'ab': 27}))), [])
+
+    def test_follow(self):
+        self.write_log('ab', [make_line(100, 0, 'a0')])
+        self.write_log('Qi', [make_line(101, 0, 'q0')])
+
+        db = ClientDatabase(self.data_dir)
+        offsets = db.get_offsets()
+        self.assertEqual(offsets, {'ab': 14, 'Qi': 14})
+        handle = db.files['ab']
+
+        with open(os.path.join(self.data_dir, 'ab'), 'a') as f:
+            f.write(make_line(102, 0, 'a1'))
+        with open(os.path.join(self.data_dir, 'Qi'), 'a') as f:
+            f.write(make_line(102, 0, 'q1'))
+
+        # only looks at the given logs
+        self.assertEqual(db.get_offsets(['ab']), {'ab': 28, 'Qi': 14})
+        self.assertIs(db.files['ab'], handle)
+        self.assertEqual(
+            [(app_id, offset) for _, app_id, offset in
+             db.read_all(offsets, ['ab'])],
+            [('ab', 14)])
+
+        # new logs are picked up anyway
+        self.write_log('9p', [make_line(99, 0, 'n0')])
+        os.utime(self.data_dir, (0, 0))
+        self.assertEqual(
+            db.get_offsets(['ab']), {'ab': 28, 'Qi': 14, '9p': 14})
+        self.assertEqual(
+            db.get_offsets(), {'ab': 28, 'Qi': 28, '9p': 14})
+
+        os.remove(os.path.join(self.data_dir, '9p'))
+        os.utime(self.data_dir, (1, 1))
+        self.assertEqual(db.get_offsets(), {'ab': 28, 'Qi': 28})
+
+        db.close()
+        self.assertEqual(db.files, {})
+
+    def test_follow_same_tick(self):
+        self.write_log('ab', [make_line(100, 0, 'a0')])
+        db = ClientDatabase(self.data_dir)
+        self.assertEqual(db.get_offsets(), {'ab': 14})
+        # too recent to rely on the mtime next time
+        self.assertIsNone(db.listed_mtime)
+
+        # listed within the same mtime tick the new log was added in
+        self.write_log('Qi', [make_line(101, 0, 'q0')])
+        db.listed_mtime = os.stat(self.data_dir).st_mtime
+        self.assertEqual(db.get_offsets(['Qi']), {'ab': 14, 'Qi': 14})
+        self.assertEqual(
+            [app_id for _, app_id, _ in
+             db.read_all(defaultdict(int), ['Qi', 'xx'])],
+            ['Qi'])
+
+    def test_follow_replaced(self):
+        self.write_log('ab', [make_line(100, 0, 'a0')])
+        db = ClientDatabase(self.data_dir)
+        self.assertEqual(db.get_offsets(), {'ab': 14})
+        self.assertEqual(db.replaced, set())
+
+        # e.g. re-encrypted and moved into place
+        path = os.path.join(self.data_dir, 'ab')
+        with open(path + '.tmp', 'w') as f:
+            f.write(make_line(100, 0, 'b0') + make_line(101, 0, 'b1'))
+        os.rename(path + '.tmp', path)
+
+        self.assertEqual(db.get_offsets(['ab']), {'ab': 28})
+        self.assertEqual(db.replaced, set(['ab']))
+        self.assertEqual(
+            [line for line, _, _ in db.read_all(defaultdict(int))],
+            [make_line(100, 0, 'b0'), make_line(101, 0, 'b1')])
+
+
+class SyncableTestCase(LogTestCase):
+    def test_get_data(self):
+        self.write_log('ab', ['foo\n', 'bar\n'])
+
+        db = Database(self.data_dir)
+        self.assertEqual(db._get_data('ab', 0), 'foo\nbar\n')
+        self.assertEqual(db._get_data('ab', 4), 'bar\n')
+        self.assertEqual(db._get_data('ab', 8), '')
+
+        # limits end on complete lines
+        self.assertEqual(db._get_data('ab', 0, 4), 'foo\n')
+        self.assertEqual(db._get_data('ab', 0, 7), 'foo\n')
+        self.assertEqual(db._get_data('ab', 0, 8), 'foo\nbar\n')
+        self.assertEqual(db._get_data('ab', 0, 100), 'foo\nbar\n')
+        # a single line over the limit is returned anyway
+        self.assertEqual(db._get_data('ab', 0, 2), 'foo\n')
+        self.assertEqual(db._get_data('ab', 4, 1), 'bar\n')
+        # nothing past stop
+        self.assertEqual(db._get_data('ab', 0, None, 4), 'foo\n')
+        self.assertEqual(db._get_data('ab', 0, 2, 6), 'foo\n')
+        self.assertEqual(db._get_data('ab', 4, 2, 6), 'ba')
+
+    def test_missing_data_limit(self):
+        self.write_log('ab', ['foo\n', 'bar\n'])
+        self.write_log('Qi', ['baz\n'])
+
+        db = Database(self.data_dir)
+        local_offs = db.get_offsets()
+        remote_offs = defaultdict(int)
+        self.assertEqual(db.get_missing_data(local_offs, remote_offs), {
+            'Qi': [0, 'baz\n'],
+            'ab': [0, 'foo\nbar\n'],
+        })
+        self.assertEqual(db.get_missing_data(local_offs, remote_offs, 6), {
+            'Qi': [0, 'baz\n'],
+            'ab': [0, 'foo\n'],
+        })
+        self.assertEqual(db.get_missing_data(local_offs, remote_offs, 4), {
+            'Qi': [0, 'baz\n'],
+        })
+
+    def test_insert_data(self):
+        self.write_log('ab', ['foo\n'])
+
+        db = Database(self.data_dir)
+        offs = db.insert_data(db.get_offsets(), {
+            'ab': [0, 'foo\nbar\n'],
+            'Qi': [0, 'baz\n'],
+        })
+        self.assertEqual(offs, {'ab': 8, 'Qi': 4})
+        self.assertEqual(offs, db.get_offsets())
+
+
+class LockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.lock_file = os.path.join(self.tmp_dir, 'lock')
+        open(self.lock_file, 'w').close()
+        self.db = Database(
+            self.tmp_dir, self.lock_file,
+            os.path.join(self.tmp_dir, 'generation'))
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def try_lock(self, operation):
+        with open(self.lock_file) as f:
+            try:
+                flock(f, operation | LOCK_NB)
+            except IOError:
+                return False
+            return True
+
+    def test_shared(self):
+        with self.db.lock(True):
+            self.assertTrue(self.try_lock(LOCK_SH))
+            self.assertFalse(self.try_lock(LOCK_EX))
+
+        with self.db.lock():
+            self.assertFalse(self.try_lock(LOCK_SH))
+
+    def test_generation(self):
+        self.assertEqual(self.db.get_generation(), 0)
+        with self.db.lock(True):
+            pass
+        self.assertEqual(self.db.get_generation(), 0)
+
+        with self.db.lock():
+            pass
+        self.assertEqual(self.db.get_generation(), 1)
+
+        # might have written something before failing
+        with self.assertRaises(ValueError):
+            with self.db.lock():
+                raise ValueError
+        self.assertEqual(self.db.get_generation(), 2)
+        self.assertTrue(self.try_lock(LOCK_EX))
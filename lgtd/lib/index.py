@@ -0,0 +1,171 @@
+from bisect import insort
+from collections import OrderedDict, defaultdict
+from datetime import date
+
+from .state import Item
+
+
+def display_tag(tag, ref_date):
+    """
+    Return the tag an item with the given tag is shown under on ref_date.
+    """
+    if not tag:
+        return 'inbox'
+
+    if tag.startswith('$'):
+        tag_date = tag[1:]
+        return 'tickler' if tag_date > ref_date else 'inbox'
+
+    return tag
+
+
+class TagIndex(object):
+    """
+    Maintain the items of each tag in item order so that a single tag can be
+    rendered without looking at all items. Scheduled items are kept by date
+    and moved from the tickler to the inbox by set_date().
+    """
+    def __init__(self, items=(), today=None):
+        self._build(items, today or str(date.today()))
+
+    def _build(self, items, today):
+        self.today = today
+        self.ranks = {}
+        self.next_rank = 0
+        # item ids by tag, '' are unscheduled inbox items
+        self.tags = defaultdict(set)
+        # scheduled item ids by date, due ones are shown in the inbox
+        self.dates = defaultdict(set)
+        self.due = set()
+        self.tickler = set()
+        # dates of tickler items in ascending order
+        self.future_dates = []
+        # item ids in item order, by display tag
+        self.sorted = {}
+
+        for item_id in items:
+            self.add(item_id, items[item_id].tag)
+
+    def __eq__(self, other):
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _key(self):
+        return (
+            self.today,
+            dict((tag, ids) for tag, ids in self.tags.iteritems() if ids),
+            dict((d, ids) for d, ids in self.dates.iteritems() if ids),
+            sorted(self.ranks, key=self.ranks.get),
+        )
+
+    def _members(self, tag):
+        if tag == 'inbox':
+            return self.tags[''] | self.due
+        elif tag == 'tickler':
+            return self.tickler
+        else:
+            return self.tags[tag]
+
+    def _invalidate(self, tag):
+        self.sorted.pop(display_tag(tag, self.today), None)
+
+    def _insert(self, item_id, tag):
+        self._invalidate(tag)
+        if tag.startswith('$'):
+            tag_date = tag[1:]
+            if not self.dates[tag_date] and tag_date > self.today:
+                insort(self.future_dates, tag_date)
+            self.dates[tag_date].add(item_id)
+            if tag_date > self.today:
+                self.tickler.add(item_id)
+            else:
+                self.due.add(item_id)
+        else:
+            self.tags[tag].add(item_id)
+
+    def _discard(self, item_id, tag):
+        self._invalidate(tag)
+        if tag.startswith('$'):
+            tag_date = tag[1:]
+            self.dates[tag_date].discard(item_id)
+            if not self.dates[tag_date] and tag_date > self.today:
+                self.future_dates.remove(tag_date)
+            self.tickler.discard(item_id)
+            self.due.discard(item_id)
+        else:
+            self.tags[tag].discard(item_id)
+
+    def add(self, item_id, tag):
+        self.ranks[item_id] = self.next_rank
+        self.next_rank += 1
+        self._insert(item_id, tag)
+
+    def remove(self, item_id, tag):
+        del self.ranks[item_id]
+        self._discard(item_id, tag)
+
+    def retag(self, item_id, old_tag, new_tag):
+        self._discard(item_id, old_tag)
+        self._insert(item_id, new_tag)
+
+    def reorder(self, item_ids):
+        """
+        Take over the order of item_ids, which are all indexed items.
+        """
+        self.ranks = dict((item_id, rank) for rank, item_id in
+                          enumerate(item_ids))
+        self.next_rank = len(self.ranks)
+        self.sorted = {}
+
+    def set_date(self, today):
+        """
+        Move scheduled items that became due to the inbox.
+        """
+        if today == self.today:
+            return
+        elif today < self.today:
+            # clock went backwards, due items might be in the future again
+            self._build(self._items(), today)
+            return
+
+        self.today = today
+        while self.future_dates and self.future_dates[0] <= today:
+            tag_date = self.future_dates.pop(0)
+            self.due |= self.dates[tag_date]
+            self.tickler -= self.dates[tag_date]
+
+        self.sorted.pop('inbox', None)
+        self.sorted.pop('tickler', None)
+
+    def _items(self):
+        tags = {}
+        for tag, ids in self.tags.iteritems():
+            for item_id in ids:
+                tags[item_id] = Item(tag=tag)
+        for tag_date, ids in self.dates.iteritems():
+            for item_id in ids:
+                tags[item_id] = Item(tag='$' + tag_date)
+
+        return OrderedDict(
+            (item_id, tags[item_id])
+            for item_id in sorted(self.ranks, key=self.ranks.get))
+
+    def count(self, tag):
+        if tag == 'inbox':
+            return len(self.tags['']) + len(self.due)
+        elif tag == 'tickler':
+            return len(self.tickler)
+        else:
+            return len(self.tags[tag])
+
+    def item_ids(self, tag):
+        """
+        Return the ids of all items shown under tag, in item order.
+        """
+        if tag not in self.sorted:
+            self.sorted[tag] = sorted(
+                self._members(tag), key=self.ranks.__getitem__)
+
+        return self.sorted[tag]
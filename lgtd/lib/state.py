@@ -0,0 +1,109 @@
+from collections import defaultdict
+
+
+class Item(object):
+    """
+    A single item of the replayed state. Tags are interned since there are
+    few distinct ones shared by many items.
+    """
+    __slots__ = ('title', 'tag')
+
+    def __init__(self, title='', tag=''):
+        self.title = title
+        self.tag = intern(tag)
+
+    def __eq__(self, other):
+        return self.title == other.title and self.tag == other.tag
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Item({!r}, {!r})'.format(self.title, self.tag)
+
+
+class TagOrder(object):
+    """
+    The ordered tags of the replayed state, as a linked hash map so that
+    membership tests, removals and moves take constant time. Also counts
+    the items of every tag to tell whether a tag is empty.
+    """
+    def __init__(self, tags=(), items=()):
+        # a link is [previous link, next link, tag], root is the sentinel
+        self.root = root = []
+        root[:] = [root, root, None]
+        self.links = {}
+        self.refs = defaultdict(int)
+
+        for tag in tags:
+            self.append(tag)
+        for item_id in items:
+            self.ref(items[item_id].tag)
+
+    def __contains__(self, tag):
+        return tag in self.links
+
+    def __len__(self):
+        return len(self.links)
+
+    def __iter__(self):
+        root = self.root
+        link = root[1]
+        while link is not root:
+            yield link[2]
+            link = link[1]
+
+    def __eq__(self, other):
+        if isinstance(other, TagOrder):
+            return list(self) == list(other) and \
+                self._nonzero_refs() == other._nonzero_refs()
+
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'TagOrder({!r})'.format(list(self))
+
+    def _nonzero_refs(self):
+        return dict((tag, n) for tag, n in self.refs.iteritems() if n)
+
+    def _link_after(self, link, tag):
+        following = link[1]
+        link[1] = following[0] = self.links[tag] = [link, following, tag]
+
+    def append(self, tag):
+        self._link_after(self.root[0], tag)
+
+    def remove(self, tag):
+        previous, following, _ = self.links.pop(tag)
+        previous[1] = following
+        following[0] = previous
+
+    def move_after(self, first, second):
+        """
+        Move second right after first, both need to be present.
+        """
+        if first != second:
+            self.remove(second)
+            self._link_after(self.links[first], second)
+
+    def index(self, tag):
+        for i, t in enumerate(self):
+            if t == tag:
+                return i
+
+        raise ValueError('{!r} is not in tag order'.format(tag))
+
+    def ref(self, tag):
+        self.refs[tag] += 1
+
+    def unref(self, tag):
+        self.refs[tag] -= 1
+
+    def is_empty(self, tag):
+        """
+        Return true if no item has the given tag.
+        """
+        return not self.refs[tag]
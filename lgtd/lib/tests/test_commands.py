@@ -4,6 +4,15 @@ from collections import OrderedDict
 from ..commands import (Command, DeleteItemCommand, DeleteTagCommand,
                         ItemTitleCommand, OrderItemsCommand, OrderTagCommand,
                         SetTagCommand, UnsetTagCommand)
+from ..state import Item, TagOrder
+
+
+def make_state(tags, items):
+    items = OrderedDict(items)
+    return {
+        'tag_order': TagOrder(tags, items),
+        'items': items,
+    }
 
 
 class CommandsTestCase(unittest.TestCase):
@@ -38,23 +47,20 @@ class CommandsTestCase(unittest.TestCase):
 
     @staticmethod
     def get_state():
-        return {
-            'tag_order': ['t1', 't2', 't3'],
-            'items': OrderedDict([
-                ('i00', {'title': 'the first item', 'tag': 't1'}),
-                ('i01', {'title': 'the second item', 'tag': 't1'}),
-            ]),
-        }
+        return make_state(['t1', 't2', 't3'], [
+            ('i00', Item('the first item', 't1')),
+            ('i01', Item('the second item', 't1')),
+        ])
 
     def test_item_title_command(self):
         state = self.get_state()
         ItemTitleCommand('i99', 'some item').apply(state)
         self.assertIn('i99', state['items'])
-        self.assertEqual(state['items']['i99']['title'], 'some item')
-        self.assertEqual(state['items']['i99']['tag'], '')
+        self.assertEqual(state['items']['i99'].title, 'some item')
+        self.assertEqual(state['items']['i99'].tag, '')
 
         ItemTitleCommand('i00', 'new title').apply(state)
-        self.assertEqual(state['items']['i00']['title'], 'new title')
+        self.assertEqual(state['items']['i00'].title, 'new title')
 
     def test_delete_item_command(self):
         state = self.get_state()
@@ -70,16 +76,22 @@ class CommandsTestCase(unittest.TestCase):
         self.assertEqual(state, self.get_state())
 
         SetTagCommand('i00', 't2').apply(state)
-        self.assertEqual(state['items']['i00']['tag'], 't2')
+        self.assertEqual(state['items']['i00'].tag, 't2')
         self.assertEqual(state['tag_order'], ['t1', 't2', 't3'])
 
         SetTagCommand('i00', '$2016-01-01').apply(state)
-        self.assertEqual(state['items']['i00']['tag'], '$2016-01-01')
+        self.assertEqual(state['items']['i00'].tag, '$2016-01-01')
         self.assertEqual(state['tag_order'], ['t1', 't2', 't3'])
 
         SetTagCommand('i01', 'new').apply(state)
-        self.assertEqual(state['tag_order'][-1], 'new')
-        self.assertEqual(state['items']['i01']['tag'], 'new')
+        self.assertEqual(list(state['tag_order'])[-1], 'new')
+        self.assertEqual(state['items']['i01'].tag, 'new')
+
+    def test_interned_tags(self):
+        state = self.get_state()
+        SetTagCommand('i00', ''.join(['t', '9'])).apply(state)
+        SetTagCommand('i01', ''.join(['t', '9'])).apply(state)
+        self.assertIs(state['items']['i00'].tag, state['items']['i01'].tag)
 
     def test_unset_tag_command(self):
         state = self.get_state()
@@ -87,7 +99,7 @@ class CommandsTestCase(unittest.TestCase):
         self.assertEqual(state, self.get_state())
 
         UnsetTagCommand('i00').apply(state)
-        self.assertEqual(state['items']['i00']['tag'], '')
+        self.assertEqual(state['items']['i00'].tag, '')
 
     def test_order_tag_command(self):
         state = self.get_state()
@@ -110,13 +122,10 @@ class CommandsTestCase(unittest.TestCase):
 
     @staticmethod
     def get_special_state():
-        return {
-            'tag_order': ['inbox', 'tickler', 'other'],
-            'items': OrderedDict([
-                ('i00', {'title': 'the first item', 'tag': 'other'}),
-                ('i01', {'title': 'the second item', 'tag': 'other'}),
-            ]),
-        }
+        return make_state(['inbox', 'tickler', 'other'], [
+            ('i00', Item('the first item', 'other')),
+            ('i01', Item('the second item', 'other')),
+        ])
 
     def test_special_tags(self):
         state = self.get_special_state()
@@ -139,16 +148,13 @@ class CommandsTestCase(unittest.TestCase):
 
     def test_order_items_application(self):
         def get_state():
-            return {
-                'tag_order': ['one', 'two'],
-                'items': OrderedDict([
-                    ('i00', {'title': 'i0', 'tag': 'one'}),
-                    ('i01', {'title': 'i1', 'tag': 'one'}),
-                    ('i02', {'title': 'i2', 'tag': 'two'}),
-                    ('i03', {'title': 'i3', 'tag': 'one'}),
-                    ('i04', {'title': 'i4', 'tag': 'one'}),
-                ]),
-            }
+            return make_state(['one', 'two'], [
+                ('i00', Item('i0', 'one')),
+                ('i01', Item('i1', 'one')),
+                ('i02', Item('i2', 'two')),
+                ('i03', Item('i3', 'one')),
+                ('i04', Item('i4', 'one')),
+            ])
 
         state = get_state()
         OrderItemsCommand([None, 'i99']).apply(state)
@@ -159,11 +165,11 @@ class CommandsTestCase(unittest.TestCase):
         self.assertEqual(state, {
             'tag_order': ['one', 'two'],
             'items': OrderedDict([
-                ('i04', {'title': 'i4', 'tag': 'one'}),
-                ('i00', {'title': 'i0', 'tag': 'one'}),
-                ('i01', {'title': 'i1', 'tag': 'one'}),
-                ('i02', {'title': 'i2', 'tag': 'two'}),
-                ('i03', {'title': 'i3', 'tag': 'one'}),
+                ('i04', Item('i4', 'one')),
+                ('i00', Item('i0', 'one')),
+                ('i01', Item('i1', 'one')),
+                ('i02', Item('i2', 'two')),
+                ('i03', Item('i3', 'one')),
             ]),
         })
 
@@ -172,10 +178,10 @@ class CommandsTestCase(unittest.TestCase):
         self.assertEqual(state, {
             'tag_order': ['one', 'two'],
             'items': OrderedDict([
-                ('i02', {'title': 'i2', 'tag': 'two'}),
-                ('i00', {'title': 'i0', 'tag': 'one'}),
-                ('i01', {'title': 'i1', 'tag': 'one'}),
-                ('i03', {'title': 'i3', 'tag': 'one'}),
-                ('i04', {'title': 'i4', 'tag': 'one'}),
+                ('i02', Item('i2', 'two')),
+                ('i00', Item('i0', 'one')),
+                ('i01', Item('i1', 'one')),
+                ('i03', Item('i3', 'one')),
+                ('i04', Item('i4', 'one')),
             ]),
         })
@@ -71,3 +71,40 @@ class CipherTestCase(unittest.TestCase):
         bad_ciphertext = maul_ciphertext(ciphertext, 44)
         with self.assertRaises(InvalidTag):
             real_cipher.decrypt(bad_ciphertext, client_id, offset)
+
+    def test_decrypt_many(self):
+        real_cipher = CommandCipher('x' * 32)
+        secrets = ['first', 'second', 'third']
+        records = [
+            (real_cipher.encrypt(secret, 'ab', offset), 'ab', offset)
+            for offset, secret in enumerate(secrets)]
+
+        self.assertEqual(list(real_cipher.decrypt_many(records)), secrets)
+
+        # one record with the wrong auth data
+        records[1] = (records[1][0], 'ba', records[1][2])
+        with self.assertRaises(InvalidTag):
+            list(real_cipher.decrypt_many(records))
+        self.assertEqual(
+            list(real_cipher.decrypt_many(records, strict=False)),
+            ['first', None, 'third'])
+
+    def test_decrypt_parallel(self):
+        real_cipher = CommandCipher('x' * 32)
+        records = [
+            (real_cipher.encrypt(str(offset), 'ab', offset), 'ab', offset)
+            for offset in xrange(50)]
+        expected = map(str, xrange(50))
+
+        for jobs in (1, 3):
+            self.assertEqual(
+                list(real_cipher.decrypt_parallel(records, jobs, True, 7)),
+                expected)
+
+        records[20] = (records[20][0], 'ba', records[20][2])
+        with self.assertRaises(InvalidTag):
+            list(real_cipher.decrypt_parallel(records, 3, True, 7))
+        expected[20] = None
+        self.assertEqual(
+            list(real_cipher.decrypt_parallel(records, 3, False, 7)),
+            expected)
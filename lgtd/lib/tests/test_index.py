@@ -0,0 +1,80 @@
+import random
+import unittest
+from collections import OrderedDict
+
+from ..commands import (DeleteItemCommand, ItemTitleCommand,
+                        OrderItemsCommand, SetTagCommand, UnsetTagCommand)
+from ..index import TagIndex, display_tag
+from ..state import Item, TagOrder
+
+
+class TagIndexTestCase(unittest.TestCase):
+    @staticmethod
+    def get_items():
+        return OrderedDict([
+            ('000', Item('first item', '')),
+            ('001', Item('second item', '$2015-12-04')),
+            ('002', Item('3rd item', '$2015-12-03')),
+            ('003', Item('item #4', '$2015-12-02')),
+            ('004', Item('other item', 'one')),
+            ('005', Item('much later', '$2015-12-24')),
+        ])
+
+    def test_display_tag(self):
+        self.assertEqual(display_tag('', '2015-12-03'), 'inbox')
+        self.assertEqual(display_tag('one', '2015-12-03'), 'one')
+        self.assertEqual(display_tag('$2015-12-03', '2015-12-03'), 'inbox')
+        self.assertEqual(display_tag('$2015-12-04', '2015-12-03'), 'tickler')
+
+    def test_lookup(self):
+        index = TagIndex(self.get_items(), '2015-12-03')
+        self.assertEqual(index.item_ids('inbox'), ['000', '002', '003'])
+        self.assertEqual(index.item_ids('tickler'), ['001', '005'])
+        self.assertEqual(index.item_ids('one'), ['004'])
+        self.assertEqual(index.item_ids('empty'), [])
+        self.assertEqual(index.count('inbox'), 3)
+        self.assertEqual(index.count('tickler'), 2)
+        self.assertEqual(index.count('empty'), 0)
+
+    def test_set_date(self):
+        index = TagIndex(self.get_items(), '2015-12-03')
+
+        index.set_date('2015-12-10')
+        self.assertEqual(
+            index.item_ids('inbox'), ['000', '001', '002', '003'])
+        self.assertEqual(index.item_ids('tickler'), ['005'])
+        self.assertEqual(index, TagIndex(self.get_items(), '2015-12-10'))
+
+        # backwards
+        index.set_date('2015-12-01')
+        self.assertEqual(index.item_ids('inbox'), ['000'])
+        self.assertEqual(index, TagIndex(self.get_items(), '2015-12-01'))
+
+    def test_commands(self):
+        tags = ['', 'one', 'two', '$2015-12-01', '$2015-12-05']
+        state = {
+            'tag_order': TagOrder(['inbox', 'tickler']),
+            'items': OrderedDict(),
+            'index': TagIndex(today='2015-12-03'),
+        }
+
+        for _ in xrange(500):
+            item_id = '{:03d}'.format(random.randint(0, 30))
+            command = random.choice([
+                ItemTitleCommand(item_id, 'title'),
+                ItemTitleCommand(item_id, 'title'),
+                DeleteItemCommand(item_id),
+                SetTagCommand(item_id, random.choice(tags)),
+                UnsetTagCommand(item_id),
+                OrderItemsCommand([None, item_id]),
+            ])
+            command.apply(state)
+
+            self.assertEqual(
+                state['index'], TagIndex(state['items'], '2015-12-03'))
+
+        for tag in ['inbox', 'tickler', 'one', 'two']:
+            self.assertEqual(state['index'].item_ids(tag), [
+                i for i, item in state['items'].iteritems()
+                if display_tag(item.tag, '2015-12-03') == tag
+            ])
@@ -0,0 +1,43 @@
+import unittest
+from collections import OrderedDict
+
+from ..state import Item, TagOrder
+
+
+class TagOrderTestCase(unittest.TestCase):
+    def test_order(self):
+        order = TagOrder(['a', 'b', 'c'])
+        self.assertEqual(list(order), ['a', 'b', 'c'])
+        self.assertEqual(len(order), 3)
+        self.assertIn('b', order)
+        self.assertNotIn('x', order)
+        self.assertEqual(order.index('c'), 2)
+        with self.assertRaises(ValueError):
+            order.index('x')
+
+        order.append('d')
+        order.move_after('a', 'c')
+        self.assertEqual(order, ['a', 'c', 'b', 'd'])
+        order.move_after('d', 'a')
+        self.assertEqual(order, ['c', 'b', 'd', 'a'])
+        order.move_after('b', 'b')
+        self.assertEqual(order, ['c', 'b', 'd', 'a'])
+
+        order.remove('c')
+        order.remove('a')
+        self.assertEqual(order, ['b', 'd'])
+        self.assertEqual(order, TagOrder(['b', 'd']))
+        self.assertNotEqual(order, TagOrder(['d', 'b']))
+
+    def test_refs(self):
+        items = OrderedDict([('000', Item('x', 'a')), ('001', Item('y', 'a'))])
+        order = TagOrder(['a', 'b'], items)
+        self.assertFalse(order.is_empty('a'))
+        self.assertTrue(order.is_empty('b'))
+        self.assertNotEqual(order, TagOrder(['a', 'b']))
+
+        order.unref('a')
+        order.unref('a')
+        order.ref('b')
+        self.assertTrue(order.is_empty('a'))
+        self.assertFalse(order.is_empty('b'))
@@ -1,11 +1,40 @@
+import random
 import unittest
 from datetime import date
 from itertools import permutations
 
 from mock import patch
 
-from ..util import (
-    ParseError, compare_digest, diff_order, parse_natural_date, patch_order)
+from ..util import (ParseError, compare_digest, diff_order, diff_state,
+                    parse_natural_date, patch_order, patch_state)
+
+
+def patch_order_reference(items, diffs):
+    """
+    The original list-based patch_order(), kept to check the semantics of
+    the linked list implementation against.
+    """
+    if None in list(items):
+        raise ValueError('items must not contain None')
+
+    reordered = [None] + list(items)
+    for diff in diffs:
+        if len(diff) != len(set(diff)):
+            raise ValueError('malformed diff')
+
+        diff = [x for i, x in enumerate(diff)
+                if x in reordered and (not i or x)]
+        if diff:
+            anchor, seq = diff[0], diff[1:]
+            offset = reordered.index(anchor)
+
+            reordered = [
+                x for x in reordered[:offset + 1] if x not in seq
+            ] + seq + [
+                x for x in reordered[offset + 1:] if x not in seq
+            ]
+
+    return reordered[1:]
 
 
 class UtilTest(unittest.TestCase):
@@ -73,10 +102,82 @@ class UtilTest(unittest.TestCase):
         diff = [['a', None]]
         self.assertEqual(patch_order(items, diff), items)
 
+    def test_patch_order_reference(self):
+        def patch(f, items, diffs):
+            try:
+                return f(items, diffs)
+            except ValueError:
+                return ValueError
+
+        # '' is falsy, 'x' to 'z' are never part of items
+        universe = list('abcdefghijxyz') + ['', None]
+        for _ in xrange(2000):
+            items = random.sample(universe[:10] + [''], random.randint(0, 11))
+            diffs = [
+                [random.choice(universe)
+                 for _ in xrange(random.randint(0, 5))]
+                for _ in xrange(random.randint(0, 4))
+            ]
+            self.assertEqual(
+                patch(patch_order, items, diffs),
+                patch(patch_order_reference, items, diffs))
+
     def test_diff_patch_order(self):
         a = list('abcdef')
         for b in permutations(a):
-            self.assertEqual(patch_order(a, diff_order(a, b)), list(b))
+            diff = diff_order(a, b)
+            self.assertEqual(patch_order(a, diff), list(b))
+
+            # only elements off a longest increasing subsequence move
+            positions = [a.index(x) for x in b]
+            lis = [1] * len(b)
+            for i in xrange(len(b)):
+                for j in xrange(i):
+                    if positions[j] < positions[i]:
+                        lis[i] = max(lis[i], lis[j] + 1)
+            moved = sum(len(d) - 1 for d in diff)
+            self.assertEqual(moved, len(a) - max(lis))
+
+    def test_diff_patch_state(self):
+        def make_state(tags, active_tag, items):
+            return {
+                'tags': [{'name': name, 'count': count}
+                         for name, count in tags],
+                'active_tag': active_tag,
+                'items': [{'id': item_id, 'title': title}
+                          for item_id, title in items],
+            }
+
+        old = make_state([('inbox', 3), ('one', 1)], 0, [
+            ('000', 'a'), ('001', 'b'), ('002', 'c')])
+        self.assertEqual(diff_state(old, old), {})
+
+        new = make_state([('inbox', 3), ('one', 0)], 0, [
+            ('002', 'c'), ('000', 'a'), ('003', 'd')])
+        delta = diff_state(old, new)
+        self.assertEqual(delta['counts'], [[1, 0]])
+        self.assertEqual(delta['removed'], ['001'])
+        self.assertEqual(delta['updated'], [{'id': '003', 'title': 'd'}])
+        self.assertEqual(patch_state(old, delta), new)
+
+        # retitle only, no order needed
+        new = make_state([('inbox', 3), ('one', 1)], 0, [
+            ('000', 'a'), ('001', 'x'), ('002', 'c')])
+        delta = diff_state(old, new)
+        self.assertEqual(delta, {'updated': [{'id': '001', 'title': 'x'}]})
+        self.assertEqual(patch_state(old, delta), new)
+
+        # tag list changed
+        new = make_state([('inbox', 3), ('two', 0), ('one', 1)], 2, [])
+        delta = diff_state(old, new)
+        self.assertEqual(delta['tags'], new['tags'])
+        self.assertEqual(patch_state(old, delta), new)
+
+        items = [(i, i) for i in 'abcdef']
+        old = make_state([], 0, items)
+        for order in permutations(items):
+            new = make_state([], 0, order[1:])
+            self.assertEqual(patch_state(old, diff_state(old, new)), new)
 
     @patch('lgtd.lib.util.date')
     def test_date_parsing(self, date_):
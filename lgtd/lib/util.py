@@ -4,9 +4,10 @@ import json
 import os
 import random
 import re
+from bisect import bisect_left
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import date, timedelta
-from difflib import SequenceMatcher
 from locale import LC_ALL, setlocale
 from stat import S_IRUSR, S_IWUSR
 
@@ -27,10 +28,22 @@ def get_lock_file():
     return os.path.join(get_lgtd_dir(), 'lock')
 
 
+def get_generation_file():
+    return os.path.join(get_lgtd_dir(), 'generation')
+
+
 def get_data_dir():
     return os.path.join(get_lgtd_dir(), 'data')
 
 
+def get_snapshot_file():
+    return os.path.join(get_lgtd_dir(), 'snapshot')
+
+
+def get_server_cert():
+    return os.path.join(get_lgtd_dir(), 'server.crt')
+
+
 def ensure_dir(path):
     try:
         os.makedirs(path)
@@ -46,13 +59,17 @@ def ensure_data_dir():
 
 
 def ensure_lock_file():
-    path = get_lock_file()
-    if os.path.isfile(path):
-        return
+    """
+    Create the lock file and the generation file, which is watched for
+    changes and needs to exist for that.
+    """
+    for path in (get_lock_file(), get_generation_file()):
+        if os.path.isfile(path):
+            continue
 
-    ensure_dir(get_lgtd_dir())
-    with open(path, 'a'):
-        pass
+        ensure_dir(get_lgtd_dir())
+        with open(path, 'a'):
+            pass
 
 
 def random_string(length):
@@ -175,17 +192,45 @@ def parse_natural_date(s):
 def diff_order(a, b):
     """
     For two permutations a and b, compute a diff (delta) that turns a into b.
+    Elements on a longest increasing subsequence of b's positions in a stay
+    where they are, every run of other elements in b becomes one diff.
     """
     if None in list(a):
         raise ValueError('sequence must not contain None')
     elif len(a) != len(b) or set(a) != set(b):
         raise ValueError('"a" is not a permutation of "b"')
 
-    return [
-        [None if start == 0 else b[start - 1]] + list(b[start:end])
-        for tag, _, _, start, end in SequenceMatcher(None, a, b).get_opcodes()
-        if tag in ('insert', 'replace')
-    ]
+    position = dict((x, i) for i, x in enumerate(a))
+
+    # tails[k] is the index into b of the smallest last element of an
+    # increasing subsequence of length k + 1 found so far
+    tails = []
+    tail_positions = []
+    links = [None] * len(b)
+    for i, x in enumerate(b):
+        k = bisect_left(tail_positions, position[x])
+        links[i] = tails[k - 1] if k else None
+        if k == len(tails):
+            tails.append(i)
+            tail_positions.append(position[x])
+        else:
+            tails[k] = i
+            tail_positions[k] = position[x]
+
+    stay = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        stay.add(i)
+        i = links[i]
+
+    diffs = []
+    for i, x in enumerate(b):
+        if i not in stay:
+            if not i or i - 1 in stay:
+                diffs.append([b[i - 1] if i else None])
+            diffs[-1].append(x)
+
+    return diffs
 
 
 def patch_order(items, diffs):
@@ -198,21 +243,118 @@ def patch_order(items, diffs):
     if None in list(items):
         raise ValueError('items must not contain None')
 
-    reordered = [None] + list(items)
+    # doubly linked list with None as the sentinel before the first and
+    # after the last element, so each diff costs O(len(diff))
+    following = {}
+    preceding = {}
+    last = None
+    for x in items:
+        following[last] = x
+        preceding[x] = last
+        last = x
+    following[last] = None
+    preceding[None] = last
+
     for diff in diffs:
         if len(diff) != len(set(diff)):
             raise ValueError('malformed diff')
 
         diff = [x for i, x in enumerate(diff)
-                if x in reordered and (not i or x)]
+                if x in following and (not i or x)]
         if diff:
             anchor, seq = diff[0], diff[1:]
-            offset = reordered.index(anchor)
 
-            reordered = [
-                x for x in reordered[:offset + 1] if x not in seq
-            ] + seq + [
-                x for x in reordered[offset + 1:] if x not in seq
-            ]
+            for x in seq:
+                following[preceding[x]] = following[x]
+                preceding[following[x]] = preceding[x]
+
+            for x in seq:
+                following[x] = following[anchor]
+                preceding[x] = anchor
+                preceding[following[anchor]] = x
+                following[anchor] = x
+                anchor = x
+
+    reordered = []
+    x = following[None]
+    while x is not None:
+        reordered.append(x)
+        x = following[x]
 
-    return reordered[1:]
+    return reordered
+
+
+def diff_state(old, new):
+    """
+    Compute a delta that turns the rendered state old into new, see
+    patch_state(). Returns an empty dict if there are no differences.
+    """
+    delta = {}
+
+    old_names = [tag['name'] for tag in old['tags']]
+    if old_names != [tag['name'] for tag in new['tags']]:
+        delta['tags'] = new['tags']
+    else:
+        counts = [
+            [i, tag['count']] for i, tag in enumerate(new['tags'])
+            if tag['count'] != old['tags'][i]['count']
+        ]
+        if counts:
+            delta['counts'] = counts
+
+    if old['active_tag'] != new['active_tag']:
+        delta['active_tag'] = new['active_tag']
+
+    old_items = dict((item['id'], item) for item in old['items'])
+    new_ids = [item['id'] for item in new['items']]
+    new_id_set = set(new_ids)
+
+    removed = [
+        item['id'] for item in old['items'] if item['id'] not in new_id_set]
+    if removed:
+        delta['removed'] = removed
+
+    updated = [
+        item for item in new['items'] if old_items.get(item['id']) != item]
+    if updated:
+        delta['updated'] = updated
+
+    # patch_state() appends new items, only send an order if that is wrong
+    expected = [
+        item['id'] for item in old['items'] if item['id'] in new_id_set
+    ] + [item_id for item_id in new_ids if item_id not in old_items]
+    if expected != new_ids:
+        delta['order'] = diff_order(expected, new_ids)
+
+    return delta
+
+
+def patch_state(state, delta):
+    """
+    Apply a delta that was created with diff_state() and return the new
+    rendered state.
+    """
+    if 'tags' in delta:
+        tags = delta['tags']
+    else:
+        tags = [dict(tag) for tag in state['tags']]
+        for i, count in delta.get('counts', []):
+            tags[i]['count'] = count
+
+    removed = set(delta.get('removed', []))
+    items = OrderedDict(
+        (item['id'], item) for item in state['items']
+        if item['id'] not in removed)
+    for item in delta.get('updated', []):
+        items[item['id']] = item
+
+    if 'order' in delta:
+        items = OrderedDict(
+            (item_id, items[item_id])
+            for item_id in patch_order(items.keys(), delta['order']))
+
+    return {
+        'tags': tags,
+        'active_tag': delta.get('active_tag', state['active_tag']),
+        'items': items.values(),
+    }
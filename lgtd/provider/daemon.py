@@ -7,7 +7,9 @@ from argparse import ArgumentParser
 from collections import OrderedDict, defaultdict
 from datetime import date, datetime, timedelta
 from getpass import getpass
+from itertools import izip, tee
 from json import dumps, loads
+from stat import S_IRUSR, S_IWUSR
 
 import pyinotify
 from cryptography.exceptions import InvalidTag
@@ -18,9 +20,27 @@ from ..lib.bucket import LeakyBucket
 from ..lib.commands import Command
 from ..lib.crypto import CommandCipher, hash_password
 from ..lib.db.client import Database
-from ..lib.util import (compare_digest, daemonize, ensure_data_dir,
-                        ensure_lock_file, get_data_dir, get_local_config,
-                        get_lock_file, random_string)
+from ..lib.index import TagIndex
+from ..lib.state import Item, TagOrder
+from ..lib.util import (compare_digest, daemonize, diff_state, ensure_data_dir,
+                        ensure_lock_file, get_data_dir, get_generation_file,
+                        get_local_config, get_lock_file, get_snapshot_file,
+                        random_string)
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MAGIC = 'lgtd-snapshot'
+# number of applied commands after which a new snapshot is written
+SNAPSHOT_INTERVAL = 1000
+# protocol extensions a client may ask for in its auth_response
+FEATURES = frozenset(['delta'])
+# replays of at least this many bytes are decrypted in parallel (if enabled)
+PARALLEL_REPLAY_SIZE = 1 << 20
+# number of applied commands after which a checkpoint is taken, late
+# commands replay from the last checkpoint before them
+CHECKPOINT_INTERVAL = 1000
+MAX_CHECKPOINTS = 4
+# commands pushed within this window are appended together
+GROUP_COMMIT_DELAY = timedelta(milliseconds=5)
 
 logger = logging.getLogger(__name__)
 
@@ -30,74 +50,348 @@ class PasswordMismatch(Exception):
 
 
 class StateManager(object):
-    def __init__(self, app_id, db, cipher):
-        self.state = {
-            'tag_order': ['inbox', 'todo', 'ref', 'someday', 'tickler'],
-            'items': OrderedDict(),
-        }
+    def __init__(self, app_id, db, cipher, snapshot_path=None, jobs=1):
+        self.state = self._initial_state()
         self.offsets = defaultdict(int)
         self.app_id = app_id
         self.cipher = cipher
         self.db = db
+        self.snapshot_path = snapshot_path
+        self.unsaved = 0
+        self.jobs = jobs
+        # bumped whenever commands are applied to the state
+        self.generation = 0
+        # serialized state messages by (generation, tag, date)
+        self.rendered = {}
+        self.cache_stats = {'hits': 0, 'misses': 0}
+        # where we expect the next command in our own log, None if unknown
+        self.log_end = None
+        # (time, app_id, offset) of the last applied line, None if unknown
+        self.last_key = None
+        # (last_key, offsets, dumped state) in applied order
+        self.checkpoints = []
+        self.since_checkpoint = 0
 
     @staticmethod
-    def _display_tag(tag, ref_date):
-        if not tag:
-            return 'inbox'
+    def _initial_state():
+        return {
+            'tag_order': TagOrder(
+                ['inbox', 'todo', 'ref', 'someday', 'tickler']),
+            'items': OrderedDict(),
+            'index': TagIndex(),
+        }
 
-        if tag.startswith('$'):
-            tag_date = tag[1:]
-            return 'tickler' if tag_date > ref_date else 'inbox'
+    @staticmethod
+    def _key(line, app_id, offset):
+        # the order of read_all()
+        return CommandCipher.extract_time(line[:10]), app_id, offset
 
-        return tag
+    def notify(self, app_ids=None):
+        """
+        Returns true if there are changes. With app_ids, only those logs
+        are checked for new commands. Commands older than ones applied
+        already, e.g. pulled from another device, make the state go back
+        to the last checkpoint before them and replay everything after it,
+        so it ends up the same as after a full replay. Logs replaced by a
+        rename are replayed from scratch along with everything else.
+        """
+        with self.db.lock(True):
+            offsets = self.db.get_offsets(app_ids)
+            if self.db.replaced:
+                # e.g. re-encrypted, nothing applied from them holds
+                logger.info('logs replaced, replaying all: {}'.format(
+                    ', '.join(sorted(self.db.replaced))))
+                offsets = self.db.get_offsets()
+                self.db.replaced.clear()
+                self._rewind()
+                grown = None
+            elif offsets == self.offsets:
+                return False
+            else:
+                grown = [
+                    app_id for app_id, offset in offsets.iteritems()
+                    if offset > self.offsets[app_id]]
+
+            oldest = None if grown is None else self._oldest_key(grown)
+            if oldest is not None and oldest < self.last_key:
+                # logs not named in app_ids may have grown as well, go back
+                # before the oldest new line of all of them
+                offsets = self.db.get_offsets()
+                self._rewind(self._oldest_key(None))
+                grown = None
+            lines = self.db.read_all(defaultdict(int, self.offsets), grown)
+
+            # small tails are not worth starting worker processes for
+            size = sum(offsets.values()) - sum(self.offsets.values())
+            jobs = self.jobs if size >= PARALLEL_REPLAY_SIZE else 1
+            self._apply(lines, jobs, size)
 
-    def notify(self):
+            self.offsets = offsets
+            self.generation += 1
+            self.rendered.clear()
+
+        if self.unsaved >= SNAPSHOT_INTERVAL:
+            self.save_snapshot()
+
+        return True
+
+    def _oldest_key(self, app_ids):
+        """
+        Return the key of the oldest line after the offsets in app_ids (in
+        all logs if None), None if there is none.
+        """
+        lines = self.db.read_all(defaultdict(int, self.offsets), app_ids)
+        try:
+            first = next(lines, None)
+        finally:
+            lines.close()
+
+        return None if first is None else self._key(*first)
+
+    def _apply(self, lines, jobs, size):
         """
-        Returns true if there are changes
+        Apply size bytes worth of lines. Only the last MAX_CHECKPOINTS
+        checkpoints are kept, so they are taken only when the remaining
+        commands (estimated by the average line length so far) would not
+        push them out again. A long replay copies the state a bounded
+        number of times.
         """
+        read = count = 0
+        last = None
+        records, to_decrypt = tee(lines)
+        plaintexts = self.cipher.decrypt_parallel(to_decrypt, jobs)
+        for last, plaintext in izip(records, plaintexts):
+            cmd = Command.parse(plaintext)
+            cmd.apply(self.state)
+            logger.debug('executing: {}'.format(str(cmd)))
+            self.unsaved += 1
+
+            line, app_id, offset = last
+            self.offsets[app_id] = offset + len(line)
+            read += len(line)
+            count += 1
+            self.since_checkpoint += 1
+            if self.since_checkpoint >= CHECKPOINT_INTERVAL and (
+                    (size - read) * count <=
+                    read * CHECKPOINT_INTERVAL * MAX_CHECKPOINTS):
+                self.last_key = self._key(*last)
+                self._checkpoint()
+
+        if last is not None:
+            self.last_key = self._key(*last)
+
+    def _checkpoint(self):
+        self.checkpoints.append((
+            self.last_key, dict(self.offsets), self._dump_state(self.state)))
+        del self.checkpoints[:-MAX_CHECKPOINTS]
+        self.since_checkpoint = 0
+
+    def _rewind(self, key=None):
+        """
+        Go back to the last checkpoint before key, or to the initial state
+        if there is none or no key is given. Later checkpoints miss the
+        commands from key on and are dropped.
+        """
+        while self.checkpoints and (
+                key is None or self.checkpoints[-1][0] >= key):
+            self.checkpoints.pop()
+
+        if self.checkpoints:
+            self.last_key, offsets, state = self.checkpoints[-1]
+            self.state = self._load_state(state)
+            self.offsets = defaultdict(int, offsets)
+        else:
+            self.last_key = None
+            self.state = self._initial_state()
+            self.offsets = defaultdict(int)
+
+        self.since_checkpoint = 0
+        logger.info('replaying from {}'.format(self.last_key))
+
+    @staticmethod
+    def _dump_state(state):
+        return {
+            'tag_order': list(state['tag_order']),
+            'items': [
+                [item_id, item.tag, item.title]
+                for item_id, item in state['items'].iteritems()
+            ],
+        }
+
+    @staticmethod
+    def _load_state(data):
+        # json hands us unicode, the rest of the state is utf-8 encoded
+        def enc(s):
+            return s.encode('utf-8') if isinstance(s, unicode) else s
+
+        items = OrderedDict(
+            (enc(item_id), Item(enc(title), enc(tag)))
+            for item_id, tag, title in data['items']
+        )
+
+        return {
+            'tag_order': TagOrder(
+                map(intern, map(enc, data['tag_order'])), items),
+            'items': items,
+            'index': TagIndex(items),
+        }
+
+    def save_snapshot(self):
+        """
+        Write the current state along with the offsets it covers.
+        """
+        if not self.snapshot_path:
+            return
+
+        plaintext = dumps({
+            'offsets': self.offsets,
+            'last_key': self.last_key,
+            'state': self._dump_state(self.state),
+        })
+        line = self.cipher.encrypt(plaintext, SNAPSHOT_MAGIC, SNAPSHOT_VERSION)
+
+        path = self.snapshot_path + '.tmp'
+        with open(path, 'w') as f:
+            os.fchmod(f.fileno(), S_IRUSR | S_IWUSR)
+            f.write('{} {}\n'.format(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+            f.write(line)
+        os.rename(path, self.snapshot_path)
+
+        self.unsaved = 0
+        logger.debug('wrote snapshot')
+
+    def restore_snapshot(self):
+        """
+        Load state and offsets from the snapshot so that only the log tail
+        needs to be replayed. Returns false (and leaves the state alone) if
+        there is no usable snapshot, i.e. a full replay is needed.
+        """
+        if not self.snapshot_path:
+            return False
+
+        try:
+            with open(self.snapshot_path) as f:
+                header = f.readline()
+                line = f.readline()
+
+            if header != '{} {}\n'.format(SNAPSHOT_MAGIC, SNAPSHOT_VERSION):
+                raise ValueError('unknown snapshot format')
+
+            data = loads(self.cipher.decrypt(
+                line, SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+            offsets = defaultdict(int, (
+                (app_id.encode('utf-8'), offset)
+                for app_id, offset in data['offsets'].iteritems()))
+            state = self._load_state(data['state'])
+            # missing in older snapshots
+            last_key = data.get('last_key')
+            if last_key is not None:
+                time, app_id, offset = last_key
+                last_key = time, app_id.encode('utf-8'), offset
+        except IOError:
+            return False
+        except (InvalidTag, KeyError, TypeError, ValueError):
+            logger.warning('ignoring corrupt snapshot')
+            return False
+
         with self.db.lock(True):
-            offsets = self.db.get_offsets()
-            if offsets == self.offsets:
+            current = self.db.get_offsets()
+
+        for app_id, offset in offsets.iteritems():
+            if offset > current[app_id]:
+                logger.warning('ignoring stale snapshot')
                 return False
 
-            for line, app_id, offset in self.db.read_all(self.offsets):
-                cmd = Command.parse(self.cipher.decrypt(line, app_id, offset))
-                cmd.apply(self.state)
-                logger.debug('executing: {}'.format(str(cmd)))
+        self.state = state
+        self.offsets = offsets
+        self.last_key = last_key
+        if last_key is not None:
+            self.checkpoints = [(last_key, dict(offsets), data['state'])]
+        self.generation += 1
+        self.rendered.clear()
+        logger.debug('restored snapshot')
+        return True
 
-            self.offsets = offsets
-            return True
+    def _encrypt(self, commands, offset):
+        lines = []
+        for command in commands:
+            line = self.cipher.encrypt(
+                command.encode('utf-8'), self.app_id, offset)
+            lines.append(line)
+            offset += len(line)
+
+        return ''.join(lines)
 
     def push_commands(self, commands):
+        """
+        Append commands with a single write. They are encrypted for the
+        expected end of the log before taking the lock, and only again
+        under it if the log ended elsewhere.
+        """
+        if self.log_end is not None:
+            data = self._encrypt(commands, self.log_end)
+
         with self.db.lock(), self.db.append(self.app_id) as f:
-            for command in commands:
-                line = self.cipher.encrypt(
-                    command.encode('utf-8'), self.app_id, f.tell())
-                f.write(line)
+            if f.tell() != self.log_end:
+                data = self._encrypt(commands, f.tell())
+            f.write(data)
+            self.log_end = f.tell()
 
-    def render_state(self, active_tag):
+    def roll_over(self):
+        """
+        Move scheduled items that became due today to the inbox.
+        """
         today = str(date.today())
-        counts = defaultdict(int)
+        if 'index' not in self.state:
+            self.state['index'] = TagIndex(self.state['items'], today)
+        elif self.state['index'].today != today:
+            self.state['index'].set_date(today)
+            self.rendered.clear()
+
+        return self.state['index']
+
+    def render_cached(self, active_tag):
+        """
+        Return the rendered state for active_tag along with its serialized
+        state message, cached until new commands are applied or the day
+        rolls over. The state must not be modified.
+        """
+        key = (self.generation, active_tag, str(date.today()))
+
+        try:
+            rendered = self.rendered[key]
+            self.cache_stats['hits'] += 1
+        except KeyError:
+            state = self.render_state(active_tag)
+            rendered = state, dumps({'msg': 'state', 'state': state})
+            self.rendered[key] = rendered
+            self.cache_stats['misses'] += 1
+
+        return rendered
+
+    def render_message(self, active_tag):
+        return self.render_cached(active_tag)[1]
+
+    def render_state(self, active_tag):
+        index = self.roll_over()
         items = []
 
         if active_tag not in self.state['tag_order']:
             active_tag = 'inbox'
 
-        for item_id, item in self.state['items'].iteritems():
-            actual_tag = self._display_tag(item['tag'], today)
-            counts[actual_tag] += 1
-            if actual_tag == active_tag:
-                data = {
-                    'id': item_id,
-                    'title': item['title'],
-                }
-                if item['tag'].startswith('$'):
-                    data['scheduled'] = item['tag'][1:]
+        for item_id in index.item_ids(active_tag):
+            item = self.state['items'][item_id]
+            data = {
+                'id': item_id,
+                'title': item.title,
+            }
+            if item.tag.startswith('$'):
+                data['scheduled'] = item.tag[1:]
 
-                items.append(data)
+            items.append(data)
 
         tags = map(
-            lambda tag: {'name': tag, 'count': counts[tag]},
+            lambda tag: {'name': tag, 'count': index.count(tag)},
             self.state['tag_order']
         )
 
@@ -108,17 +402,45 @@ class StateManager(object):
         }
 
 
+class CommandBatcher(object):
+    """
+    Collect the commands that clients push within GROUP_COMMIT_DELAY and
+    append them together, so that a burst of pushes costs one lock cycle
+    and one change notification instead of one per push.
+    """
+    def __init__(self, state_manager, ioloop, delay=GROUP_COMMIT_DELAY):
+        self.state_manager = state_manager
+        self.ioloop = ioloop
+        self.delay = delay
+        self.pending = []
+
+    def push(self, commands):
+        if not self.pending:
+            self.ioloop.add_timeout(self.delay, self.flush)
+        self.pending.extend(commands)
+
+    def flush(self):
+        commands, self.pending = self.pending, []
+        if commands:
+            self.state_manager.push_commands(commands)
+
+
 class GTDSocketHandler(WebSocketHandler):
     class AuthenticationError(Exception):
         pass
 
-    def initialize(self, config, auth_bucket, clients, state_manager):
+    def initialize(self, config, auth_bucket, clients, state_manager,
+                   batcher):
         self.clients = clients
         self.state_manager = state_manager
+        self.batcher = batcher
         self.authenticated = False
         self.nonce = random_string(16)
         self.key = config['local_auth']
         self.auth_bucket = auth_bucket
+        self.features = frozenset()
+        # last state sent to a client that receives deltas
+        self.view = None
 
     def check_origin(self, origin):
         return True
@@ -143,23 +465,45 @@ class GTDSocketHandler(WebSocketHandler):
             return
 
         if data['msg'] == 'auth_response':
-            self.write_message('{"msg": "authenticated"}')
+            self.features = FEATURES.intersection(data.get('features', []))
+            self.write_message(dumps({
+                'msg': 'authenticated',
+                'features': sorted(self.features),
+            }))
         elif data['msg'] == 'request_state':
             logger.debug('replying with state')
-            state = self.state_manager.render_state(
+            state, message = self.state_manager.render_cached(
                 data['tag'].encode('utf-8'))
-            self.write_message(dumps({'msg': 'state', 'state': state}))
+            if 'delta' in self.features:
+                self.view = state
+            self.write_message(message)
         elif data['msg'] == 'push_commands':
             logger.debug('pushing some commands')
-            self.state_manager.push_commands(data['cmds'])
+            self.batcher.push(data['cmds'])
+        elif data['msg'] == 'request_stats':
+            self.write_message(dumps({
+                'msg': 'stats',
+                'stats': {'render_cache': self.state_manager.cache_stats},
+            }))
 
     def on_close(self):
         self.clients.remove(self)
         logger.debug('client disconnected')
 
     def notify(self):
-        if self.authenticated:
+        if not self.authenticated:
+            return
+
+        if self.view is None:
             self.write_message('{"msg": "new_state"}')
+            return
+
+        tag = self.view['tags'][self.view['active_tag']]['name']
+        state, _ = self.state_manager.render_cached(tag)
+        delta = diff_state(self.view, state)
+        self.view = state
+        if delta:
+            self.write_message(dumps({'msg': 'state_delta', 'delta': delta}))
 
     def authenticate(self, data):
         if self.authenticated:
@@ -177,9 +521,42 @@ class GTDSocketHandler(WebSocketHandler):
             raise self.AuthenticationError
 
 
+class LogEvents(pyinotify.ProcessEvent):
+    """
+    Collect the app_ids of the logs that changed, None if any might have.
+    """
+    def my_init(self):
+        self.dirty = set()
+
+    def process_IN_Q_OVERFLOW(self, event):
+        logger.warning('inotify queue overflowed, checking all logs')
+        self.dirty = None
+
+    def process_default(self, event):
+        if self.dirty is not None:
+            self.dirty.add(event.name)
+
+    def pop(self):
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+
 def change_callback(notifier):
-    logger.debug('change?')
-    if notifier.state_manager.notify():
+    """
+    Called after every batch of events. Changes are applied once per
+    IOLoop iteration however many batches arrive in it.
+    """
+    if not notifier.scheduled:
+        notifier.scheduled = True
+        ioloop.IOLoop.current().add_callback(apply_changes, notifier)
+
+
+def apply_changes(notifier):
+    notifier.scheduled = False
+    app_ids = notifier.log_events.pop()
+    logger.debug('change in {}?'.format(
+        'all logs' if app_ids is None else ', '.join(app_ids)))
+    if notifier.state_manager.notify(app_ids):
         logger.debug('change - notifying clients')
         for client in notifier.clients:
             client.notify()
@@ -195,19 +572,21 @@ def delta_to_midnight():
     return midnight - now
 
 
-def midnight_callback(ioloop, clients):
+def midnight_callback(ioloop, clients, state_manager):
     """
     Make sure clients receive new state after the day rolls over (may affect
     inbox and tickler for scheduled items).
     """
+    state_manager.roll_over()
     for client in clients:
         client.notify()
 
-    schedule_midnight(ioloop, clients)
+    schedule_midnight(ioloop, clients, state_manager)
 
 
-def schedule_midnight(ioloop, clients):
-    ioloop.add_timeout(delta_to_midnight(), midnight_callback, ioloop, clients)
+def schedule_midnight(ioloop, clients, state_manager):
+    ioloop.add_timeout(
+        delta_to_midnight(), midnight_callback, ioloop, clients, state_manager)
 
 
 def parse_args():
@@ -217,6 +596,9 @@ def parse_args():
         'for the encryption passphrase and starting to listen')
     parser.add_argument(
         '-p', '--port', type=int, default=9001, help='port to listen on')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, help='number of processes to '
+        'decrypt large replays with')
     return parser.parse_args()
 
 
@@ -224,19 +606,29 @@ def setup_server(args, config, key):
     clients = []
     state_manager = StateManager(
         config['app_id'],
-        Database(get_data_dir(), get_lock_file()), CommandCipher(key))
+        Database(get_data_dir(), get_lock_file(), get_generation_file()),
+        CommandCipher(key),
+        get_snapshot_file(), args.jobs)
 
     ensure_lock_file()
     ensure_data_dir()
     wm = pyinotify.WatchManager()
+    log_events = LogEvents()
     notifier = pyinotify.TornadoAsyncNotifier(
-        wm, ioloop.IOLoop.current(), change_callback, pyinotify.ProcessEvent())
+        wm, ioloop.IOLoop.current(), change_callback, log_events)
     notifier.clients = clients
     notifier.state_manager = state_manager
-    wm.add_watch(get_lock_file(), pyinotify.IN_CLOSE_WRITE)
-
-    # make sure initial state is prepared
-    fresh = not state_manager.notify()
+    notifier.log_events = log_events
+    notifier.scheduled = False
+    # events name the log that changed
+    wm.add_watch(
+        get_data_dir(),
+        pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO)
+
+    # make sure initial state is prepared, a snapshot that decrypts fine
+    # means the key is known to be good
+    restored = state_manager.restore_snapshot()
+    fresh = not state_manager.notify() and not restored
     auth_bucket = LeakyBucket(timedelta(seconds=3), 3)
 
     app = web.Application([
@@ -244,11 +636,13 @@ def setup_server(args, config, key):
             'config': config,
             'auth_bucket': auth_bucket,
             'clients': clients,
-            'state_manager': state_manager}),
+            'state_manager': state_manager,
+            'batcher': CommandBatcher(
+                state_manager, ioloop.IOLoop.current())}),
     ])
     app.listen(args.port, address='127.0.0.1')
 
-    schedule_midnight(ioloop.IOLoop.current(), clients)
+    schedule_midnight(ioloop.IOLoop.current(), clients, state_manager)
 
     return fresh
 
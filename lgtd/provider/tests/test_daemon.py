@@ -1,10 +1,21 @@
+import os
 import unittest
 from collections import OrderedDict
 from datetime import date, datetime
+from json import dumps, loads
+from shutil import rmtree
+from tempfile import mkdtemp
 
-from mock import patch
+from mock import Mock, patch
+from tornado.ioloop import IOLoop
 
-from ..daemon import StateManager, delta_to_midnight
+from ...lib.crypto import CommandCipher
+from ...lib.db.client import Database
+from ...lib.state import Item, TagOrder
+from ...lib.util import patch_state
+from ..daemon import (CommandBatcher, GTDSocketHandler, LogEvents,
+                      StateManager, apply_changes, change_callback,
+                      delta_to_midnight)
 
 
 class DaemonTestCase(unittest.TestCase):
@@ -13,15 +24,16 @@ class DaemonTestCase(unittest.TestCase):
         setattr(mock_date, 'today', lambda: date(2015, 12, 3))
 
         sm = StateManager(None, None, None)
+        items = OrderedDict([
+            ('000', Item('first item', '')),
+            ('001', Item('second item', '$2015-12-04')),
+            ('002', Item('3rd item', '$2015-12-03')),
+            ('003', Item('item #4', '$2015-12-02')),
+            ('004', Item('other item', 'one')),
+        ])
         sm.state = {
-            'tag_order': ['inbox', 'tickler', 'one', 'empty'],
-            'items': OrderedDict([
-                ('000', {'title': 'first item', 'tag': ''}),
-                ('001', {'title': 'second item', 'tag': '$2015-12-04'}),
-                ('002', {'title': '3rd item', 'tag': '$2015-12-03'}),
-                ('003', {'title': 'item #4', 'tag': '$2015-12-02'}),
-                ('004', {'title': 'other item', 'tag': 'one'}),
-            ]),
+            'tag_order': TagOrder(['inbox', 'tickler', 'one', 'empty'], items),
+            'items': items,
         }
 
         expected = {
@@ -60,3 +72,302 @@ class DaemonTestCase(unittest.TestCase):
         setattr(mock_datetime, 'now', now)
         expected = datetime(2016, 2, 1, 0, 5) - now()
         self.assertEqual(delta_to_midnight(), expected)
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'data')
+        self.lock_file = os.path.join(self.tmp_dir, 'lock')
+        self.snapshot_file = os.path.join(self.tmp_dir, 'snapshot')
+        os.mkdir(self.data_dir)
+        open(self.lock_file, 'w').close()
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def make_state_manager(self, key='k' * 32):
+        return StateManager(
+            'ab', Database(self.data_dir, self.lock_file),
+            CommandCipher(key), self.snapshot_file)
+
+    @patch('lgtd.lib.crypto.datetime')
+    def append_at(self, app_id, second, command, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2016, 1, 1, 0, 0, second)
+        path = os.path.join(self.data_dir, app_id)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        with open(path, 'a') as f:
+            f.write(CommandCipher('k' * 32).encrypt(command, app_id, offset))
+
+    def test_snapshot(self):
+        sm = self.make_state_manager()
+        self.assertFalse(sm.restore_snapshot())
+        sm.push_commands([u't 000 first', u't 001 s\xe9cond', u'T 001 one'])
+        sm.notify()
+        sm.save_snapshot()
+
+        sm.push_commands([u't 002 third', u'd 000'])
+        sm.notify()
+
+        restored = self.make_state_manager()
+        self.assertTrue(restored.restore_snapshot())
+        self.assertEqual(restored.state['items'].keys(), ['000', '001'])
+        self.assertTrue(restored.notify())  # replays the tail only
+        self.assertEqual(restored.state, sm.state)
+        self.assertEqual(restored.offsets, sm.offsets)
+
+        # wrong key
+        self.assertFalse(
+            self.make_state_manager('x' * 32).restore_snapshot())
+
+        # stale
+        with open(os.path.join(self.data_dir, 'ab'), 'r+') as f:
+            f.truncate(10)
+        self.assertFalse(self.make_state_manager().restore_snapshot())
+
+        # corrupt
+        with open(self.snapshot_file, 'w') as f:
+            f.write('garbage')
+        self.assertFalse(self.make_state_manager().restore_snapshot())
+
+    @patch('lgtd.provider.daemon.CHECKPOINT_INTERVAL', 1)
+    def test_late_commands_unnamed(self):
+        self.append_at('cd', 1, 't 000 A')
+        for second, command in [
+                (10, 't 000 C'), (20, 't 001 x'), (30, 't 002 y')]:
+            self.append_at('ab', second, command)
+
+        sm = self.make_state_manager()
+        sm.notify()
+
+        # both grow, the event of cd comes in a later batch
+        self.append_at('cd', 5, 't 000 B')
+        self.append_at('ef', 15, 't 003 z')
+        self.assertTrue(sm.notify(['ef']))
+        self.assertFalse(sm.notify(['cd']))
+
+        replayed = self.make_state_manager()
+        replayed.notify()
+        self.assertEqual(sm.state['items']['000'].title, 'C')
+        self.assertEqual(replayed.state, sm.state)
+        self.assertEqual(replayed.offsets, sm.offsets)
+
+    def test_replaced_log(self):
+        sm = self.make_state_manager()
+        sm.push_commands([u't 000 first', u't 001 second'])
+        self.append_at('cd', 1, 't 002 other')
+        sm.notify()
+
+        # re-encrypted under the same key with different content
+        cipher = CommandCipher('k' * 32)
+        path = os.path.join(self.data_dir, 'ab')
+        with open(path + '.tmp', 'w') as f:
+            f.write(cipher.encrypt('t 000 renamed', 'ab', 0))
+        os.rename(path + '.tmp', path)
+
+        self.assertTrue(sm.notify(['ab']))
+        self.assertEqual(
+            [item.title for item in sm.state['items'].values()],
+            ['other', 'renamed'])
+
+        replayed = self.make_state_manager()
+        replayed.notify()
+        self.assertEqual(replayed.state, sm.state)
+        self.assertEqual(replayed.offsets, sm.offsets)
+        self.assertFalse(sm.notify(['ab']))
+
+    @patch('lgtd.provider.daemon.CHECKPOINT_INTERVAL', 2)
+    def test_late_commands(self):
+        for second, command in [
+                (0, 't 000 a'), (10, 't 001 b'), (20, 't 002 c'),
+                (30, 'T 001 one'), (40, 't 000 first'), (50, 't 003 d')]:
+            self.append_at('ab', second, command)
+
+        sm = self.make_state_manager()
+        sm.notify()
+        self.assertEqual(len(sm.checkpoints), 3)
+
+        # another device was offline, its commands are older than ours
+        self.append_at('cd', 25, 't 000 late')
+        self.append_at('cd', 35, 'd 002')
+        self.assertTrue(sm.notify(['cd']))
+        # rewound to the checkpoint at second 10
+        self.assertEqual(len(sm.checkpoints), 4)
+        self.assertEqual(
+            [item.title for item in sm.state['items'].values()],
+            ['first', 'b', 'd'])
+
+        replayed = self.make_state_manager()
+        replayed.notify()
+        self.assertEqual(replayed.state, sm.state)
+        self.assertEqual(replayed.offsets, sm.offsets)
+        self.assertEqual(replayed.last_key, sm.last_key)
+
+        # the snapshot is a checkpoint too
+        sm.save_snapshot()
+        restored = self.make_state_manager()
+        self.assertTrue(restored.restore_snapshot())
+        self.assertEqual(restored.last_key, sm.last_key)
+        self.append_at('cd', 5, 't 004 early')
+        restored.notify()
+        sm.notify()
+        self.assertEqual(restored.state, sm.state)
+
+    @patch('lgtd.provider.daemon.CHECKPOINT_INTERVAL', 2)
+    @patch('lgtd.provider.daemon.MAX_CHECKPOINTS', 2)
+    def test_replay_checkpoints(self):
+        self.make_state_manager().push_commands(
+            [u't {:03d} item'.format(i) for i in xrange(40)])
+
+        sm = self.make_state_manager()
+        with patch.object(
+                StateManager, '_dump_state',
+                wraps=StateManager._dump_state) as dump_state:
+            sm.notify()
+        # only the checkpoints that are kept are taken
+        self.assertEqual(dump_state.call_count, 3)
+        line_length = sm.offsets['ab'] // 40
+        self.assertEqual(
+            [offsets for _, offsets, _ in sm.checkpoints],
+            [{'ab': 38 * line_length}, {'ab': 40 * line_length}])
+
+    @patch('lgtd.provider.daemon.PARALLEL_REPLAY_SIZE', 0)
+    def test_parallel_replay(self):
+        sm = self.make_state_manager()
+        sm.push_commands([u't 000 first', u't 001 second', u'T 001 one'])
+        sm.notify()
+
+        parallel = StateManager(
+            'ab', Database(self.data_dir, self.lock_file),
+            CommandCipher('k' * 32), jobs=2)
+        self.assertTrue(parallel.notify())
+        self.assertEqual(parallel.state, sm.state)
+
+    @patch('lgtd.provider.daemon.date')
+    def test_roll_over(self, mock_date):
+        setattr(mock_date, 'today', lambda: date(2015, 12, 3))
+        sm = self.make_state_manager()
+        sm.push_commands([u't 000 first', u'T 000 $2015-12-04'])
+        sm.notify()
+        self.assertEqual(sm.render_state('tickler')['items'], [
+            {'id': '000', 'title': 'first', 'scheduled': '2015-12-04'}])
+
+        setattr(mock_date, 'today', lambda: date(2015, 12, 4))
+        sm.roll_over()
+        self.assertEqual(sm.render_state('inbox')['items'], [
+            {'id': '000', 'title': 'first', 'scheduled': '2015-12-04'}])
+
+    def test_render_cache(self):
+        sm = self.make_state_manager()
+        sm.push_commands([u't 000 first'])
+        sm.notify()
+
+        message = sm.render_message('inbox')
+        state = sm.render_state('inbox')
+        self.assertEqual(loads(message), {'msg': 'state', 'state': state})
+        self.assertIs(sm.render_message('inbox'), message)
+        sm.render_message('todo')
+        self.assertEqual(sm.cache_stats, {'hits': 1, 'misses': 2})
+
+        self.assertFalse(sm.notify())  # nothing new, cache stays
+        sm.render_message('inbox')
+        self.assertEqual(sm.cache_stats, {'hits': 2, 'misses': 2})
+
+        sm.push_commands([u't 001 second'])
+        sm.notify()
+        state = loads(sm.render_message('inbox'))['state']
+        self.assertEqual(len(state['items']), 2)
+        self.assertEqual(sm.cache_stats, {'hits': 2, 'misses': 3})
+
+    def test_group_commit(self):
+        sm = self.make_state_manager()
+        batcher = CommandBatcher(sm, Mock())
+        batcher.push([u't 000 first'])
+        batcher.push([u't 001 second', u'T 001 one'])
+        self.assertEqual(batcher.ioloop.add_timeout.call_count, 1)
+        batcher.flush()
+        batcher.flush()
+
+        # the log grows behind sm's back, encrypted offsets must follow
+        self.make_state_manager().push_commands([u't 002 third'])
+        sm.push_commands([u't 003 fourth'])
+
+        replayed = self.make_state_manager()
+        replayed.notify()
+        self.assertEqual(
+            [item.title for item in replayed.state['items'].values()],
+            ['first', 'second', 'third', 'fourth'])
+
+    def test_change_callback(self):
+        class Event(object):
+            name = 'ab'
+
+        sm = self.make_state_manager()
+        sm.push_commands([u't 000 first'])
+        client = Mock()
+        notifier = Mock(
+            scheduled=False, clients=[client], state_manager=sm,
+            log_events=LogEvents())
+
+        loop = IOLoop()
+        loop.make_current()
+        try:
+            with patch.object(sm, 'notify', wraps=sm.notify) as notify:
+                # two batches of events within one iteration
+                notifier.log_events.process_default(Event())
+                change_callback(notifier)
+                notifier.log_events.process_default(Event())
+                change_callback(notifier)
+                loop.add_callback(loop.stop)
+                loop.start()
+
+            notify.assert_called_once_with(set(['ab']))
+            self.assertEqual(client.notify.call_count, 1)
+            self.assertEqual(len(sm.state['items']), 1)
+
+            # a new log, added in the tick sm last listed the directory in
+            Event.name = 'cd'
+            self.append_at('cd', 0, 't 001 second')
+            sm.db.listed_mtime = os.stat(self.data_dir).st_mtime
+            notifier.log_events.process_default(Event())
+            apply_changes(notifier)
+            self.assertEqual(client.notify.call_count, 2)
+            self.assertEqual(len(sm.state['items']), 2)
+
+            notifier.log_events.process_IN_Q_OVERFLOW(None)
+            self.assertIsNone(notifier.log_events.pop())
+            self.assertEqual(notifier.log_events.pop(), set())
+        finally:
+            IOLoop.clear_current()
+            loop.close()
+
+    def test_delta_push(self):
+        sm = self.make_state_manager()
+        sm.push_commands([u't 000 first', u't 001 second'])
+        sm.notify()
+
+        client = GTDSocketHandler.__new__(GTDSocketHandler)
+        client.initialize({'local_auth': ''}, None, [], sm, None)
+        client.authenticated = True
+        client.write_message = Mock()
+        client.on_message(dumps({
+            'msg': 'auth_response', 'features': ['delta', 'unknown']}))
+        self.assertEqual(loads(client.write_message.call_args[0][0]), {
+            'msg': 'authenticated', 'features': ['delta']})
+
+        client.on_message(dumps({'msg': 'request_state', 'tag': 'inbox'}))
+        view = loads(client.write_message.call_args[0][0])['state']
+
+        sm.push_commands([u'd 000', u't 002 third', u'T 001 one'])
+        sm.notify()
+        client.notify()
+        message = loads(client.write_message.call_args[0][0])
+        self.assertEqual(message['msg'], 'state_delta')
+        self.assertEqual(
+            patch_state(view, message['delta']),
+            loads(sm.render_message('inbox'))['state'])
+
+        # nothing to tell
+        client.write_message.reset_mock()
+        client.notify()
+        self.assertFalse(client.write_message.called)
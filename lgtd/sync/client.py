@@ -1,22 +1,33 @@
 import logging
 import logging.handlers
 import os
+import select
+import threading
+import time
 from argparse import ArgumentParser
 from collections import defaultdict
 from datetime import datetime, timedelta
-from json import dumps
 
 import pyinotify
 import requests
+from requests.adapters import HTTPAdapter
 
 from ..lib.db.syncable import Database
 from ..lib.util import (daemonize, ensure_lock_file, get_data_dir,
-                        get_lock_file, get_sync_config)
+                        get_generation_file, get_lock_file, get_server_cert,
+                        get_sync_config)
+from .wire import CONTENT_TYPES, FRAMES_ZLIB, JSON, decode, encode, offsets_tag
 
 SYNC_PERIODIC_INTERVAL = timedelta(minutes=15)
 SYNC_DELAY = timedelta(seconds=10)
 SYNC_RETRY_DELAY = timedelta(seconds=30)
 REQUEST_TIMEOUT = timedelta(seconds=5)
+# a bit longer than the server holds wait requests
+WAIT_TIMEOUT = timedelta(minutes=5) + REQUEST_TIMEOUT
+# bytes to pull at most per request
+PULL_LIMIT = 1 << 20
+# connections kept open to the sync host per session
+POOL_SIZE = 2
 
 logger = logging.getLogger(__name__)
 
@@ -53,70 +64,242 @@ class ProcessEvent(pyinotify.ProcessEvent):
             self.schedule(SYNC_DELAY)
 
 
-def make_request(url, data):
-    response = requests.post(
-        url, data=data, timeout=REQUEST_TIMEOUT.total_seconds())
+class RemoteWatcher(threading.Thread):
+    """
+    Long-poll the server for changes made by other clients and wake up
+    the main loop through a pipe when there are any.
+    """
+    def __init__(self, config, db):
+        super(RemoteWatcher, self).__init__()
+        self.daemon = True
+        self.config = config
+        self.db = db
+        # sessions are not thread safe
+        self.session = make_session()
+        self.read_fd, self.write_fd = os.pipe()
+
+    def local_tag(self):
+        with self.db.lock(True):
+            return offsets_tag(self.db.get_offsets())
+
+    def run(self):
+        tag = self.local_tag()
+        while True:
+            try:
+                response = self.session.post(
+                    sync_url(self.config, 'wait'),
+                    timeout=WAIT_TIMEOUT.total_seconds(),
+                    headers={'If-None-Match': tag})
+                if response.status_code == 404:
+                    logger.info('server does not support waiting')
+                    return
+                response.raise_for_status()
+            except requests.exceptions.RequestException:
+                logger.exception('waiting for changes failed: ')
+                time.sleep(SYNC_RETRY_DELAY.total_seconds())
+                continue
+
+            if response.status_code == 304:
+                continue
+
+            # wait for the next change of the server's offsets, but only
+            # wake up if they are not ours (e.g. after our own push)
+            tag = response.headers['Etag']
+            if tag != self.local_tag():
+                logger.debug('remote change notification')
+                os.write(self.write_fd, '.')
+
+    def clear(self):
+        os.read(self.read_fd, 4096)
+
+
+def make_session():
+    """
+    Return a session that keeps connections to the sync host alive, so
+    that a sync does not pay for a TCP and TLS handshake per request. The
+    server certificate is verified against server.crt if it exists.
+    """
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(
+        pool_connections=1, pool_maxsize=POOL_SIZE))
+    session.headers['Accept'] = ', '.join(CONTENT_TYPES)
+
+    if os.path.isfile(get_server_cert()):
+        session.verify = get_server_cert()
+
+    return session
+
+
+def make_request(session, url, data, content_type=JSON, headers=None):
+    headers = dict(headers or {})
+    headers['Content-Type'] = content_type
+
+    response = session.post(
+        url, data=data, timeout=REQUEST_TIMEOUT.total_seconds(),
+        headers=headers)
     response.raise_for_status()
     return response
 
 
-def sync(config, db):
-    with db.lock(True):
-        local_offs = db.get_offsets()
+def decode_response(response):
+    return decode(response.content, response.headers.get('Content-Type'))
 
-    logger.debug('sync: pull')
-    response = make_request(
-        sync_url(config, 'pull'), dumps({'offs': local_offs}))
-    response.raise_for_status()
-    remote = response.json()
-    if remote['data'] and db.is_gapless(local_offs, remote['data']):
-        if db.is_gapless(local_offs, remote['data']):
-            logger.debug('sync: new data from pull')
-            with db.lock():
-                db.insert_data(local_offs, remote['data'])
 
+def pull(config, db, session, local_offs, response=None):
+    """
+    Pull until the server has nothing more for us, starting with the given
+    response if any. Return the local offsets, the last response and its
+    decoded content, which are both None if the server had the same data.
+    """
+    while True:
+        if response is None:
+            logger.debug('sync: pull')
+            response = make_request(session, sync_url(config, 'pull'), encode(
+                JSON, offs=local_offs, limit=PULL_LIMIT), headers={
+                    'If-None-Match': offsets_tag(local_offs),
+                })
+
+        if response.status_code == 304:
+            # same offsets on both sides, nothing to pull or push
+            logger.debug('sync: nothing changed')
+            return local_offs, None, None
+
+        remote = decode_response(response)
+        if not remote['data'] or not db.is_gapless(local_offs, remote['data']):
+            return local_offs, response, remote
+
+        logger.debug('sync: new data from pull')
+        with db.lock():
+            db.insert_data(local_offs, remote['data'])
+            local_offs = db.get_offsets()
+
+        if not remote.get('more'):
+            return local_offs, response, remote
+
+        response = None
+
+
+def push(config, db, session, local_offs, response, remote):
+    """
+    Push what the server is missing according to its offsets in the last
+    response. Return the offsets of the server afterwards.
+    """
+    server_offs = defaultdict(int, remote['offs'])
     with db.lock(True):
-        missing_data = db.get_missing_data(
-            local_offs, defaultdict(int, remote['offs']))
-        if missing_data:
-            logger.debug('sync: push')
-            make_request(
-                sync_url(config, 'push'), dumps({'data': missing_data}))
-        else:
-            logger.debug('sync: no push needed')
-
+        missing_data = db.get_missing_data(local_offs, server_offs)
+
+    if not missing_data:
+        logger.debug('sync: no push needed')
+        return server_offs
+
+    # servers that send framed data also accept it
+    content_type = FRAMES_ZLIB if response.headers.get(
+        'Content-Type') == FRAMES_ZLIB else JSON
+    logger.debug('sync: push')
+    make_request(
+        session, sync_url(config, 'push'),
+        encode(content_type, data=missing_data), content_type)
+
+    for app_id, (offset, data) in missing_data.iteritems():
+        server_offs[app_id] = offset + len(data)
+
+    return server_offs
+
+
+def sync(config, db, session, server_offs=None, unsupported=None):
+    """
+    Sync in a single round trip if possible: send the data the server is
+    missing according to server_offs, its offsets after the last sync, and
+    get what we are missing in return. Whatever is left, because of paging
+    or outdated server_offs, is done with separate pulls and pushes, which
+    is also all that servers without the sync endpoint get. The sync
+    endpoint is added to the set unsupported if the server lacks it and
+    not tried again while it is in there. Return the offsets of the server.
+    """
+    if unsupported is None:
+        unsupported = set()
 
-def try_sync(config, db):
+    with db.lock(True):
+        local_offs = db.get_offsets()
+        data = {} if server_offs is None or 'sync' in unsupported else \
+            db.get_missing_data(local_offs, defaultdict(int, server_offs))
+
+    response = None
+    if 'sync' not in unsupported:
+        try:
+            logger.debug('sync: push and pull')
+            # servers with the sync endpoint all accept framed data
+            response = make_request(
+                session, sync_url(config, 'sync'), encode(
+                    FRAMES_ZLIB, offs=local_offs, limit=PULL_LIMIT,
+                    data=data),
+                FRAMES_ZLIB, headers={
+                    'If-None-Match': offsets_tag(local_offs),
+                })
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+            logger.info('server does not support sync, using pull and push')
+            unsupported.add('sync')
+
+    local_offs, response, remote = pull(
+        config, db, session, local_offs, response)
+    if response is None:
+        return local_offs
+
+    return push(config, db, session, local_offs, response, remote)
+
+
+def try_sync(config, db, session, server_offs, unsupported):
+    """
+    Sync and return the offsets of the server, None if syncing failed.
+    """
     try:
         start = datetime.now()
         logger.info('syncing now...')
-        sync(config, db)
+        return sync(config, db, session, server_offs, unsupported)
     except requests.exceptions.RequestException:
         logger.exception('sync failed: ')
-        return False
+        return None
     finally:
         logger.info('sync done, took {}'.format(datetime.now() - start))
 
-    return True
-
 
 def loop(config, db):
     wm = pyinotify.WatchManager()
-    wm.add_watch(get_lock_file(), pyinotify.IN_CLOSE_WRITE)
+    wm.add_watch(get_generation_file(), pyinotify.IN_CLOSE_WRITE)
     pe = ProcessEvent(db=db)
     notifier = pyinotify.Notifier(wm, pe)
 
+    session = make_session()
+    # offsets of the server as of the last sync, unknown at first
+    server_offs = None
+    # endpoints the server answered with 404
+    unsupported = set()
+    watcher = RemoteWatcher(config, db)
+    watcher.start()
+
+    poll = select.poll()
+    poll.register(wm.get_fd(), select.POLLIN)
+    poll.register(watcher.read_fd, select.POLLIN)
+
     while True:
         with db.lock(True):
             pe.last_local_offs = db.get_offsets()
 
         logger.debug('waiting for events up to %d ms' % pe.timeout())
-        if notifier.check_events(pe.timeout()):
-            notifier.read_events()
-            notifier.process_events()
+        for fd, _ in poll.poll(pe.timeout()):
+            if fd == watcher.read_fd:
+                watcher.clear()
+                pe.schedule(timedelta())
+            else:
+                notifier.read_events()
+                notifier.process_events()
 
         if datetime.now() >= pe.next_sync:
-            if try_sync(config, db):
+            result = try_sync(config, db, session, server_offs, unsupported)
+            if result is not None:
+                server_offs = result
                 pe.schedule(SYNC_PERIODIC_INTERVAL)
             else:
                 pe.schedule(SYNC_RETRY_DELAY)
@@ -159,4 +342,5 @@ def run():
     else:
         logging.basicConfig(level=logging.DEBUG)
 
-    loop(config, Database(get_data_dir(), get_lock_file()))
+    loop(config, Database(
+        get_data_dir(), get_lock_file(), get_generation_file()))
@@ -1,19 +1,28 @@
 import os
 import re
+import time
 from argparse import ArgumentParser
 from collections import defaultdict
-from json import loads
+from datetime import timedelta
+from json import dumps
 from logging import INFO, getLogger
 from logging.handlers import SysLogHandler
 
-from tornado import httpserver, ioloop, web
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen, httpserver, ioloop, locks, web
+from tornado.concurrent import dummy_executor
 from tornado.log import LogFormatter
 
 from ..lib.constants import APP_ID_LEN
+from ..lib.db.base import MTIME_GRANULARITY
 from ..lib.db.syncable import Database
+from .wire import (JSON, Encoder, decode, is_framed, matches_tag,
+                   negotiate, offsets_tag)
 
 IS_VALID_APP_ID = re.compile('^[a-zA-Z0-9]{%d}$' % APP_ID_LEN).match
 IS_VALID_TOKEN = re.compile('^[a-zA-Z0-9]{10}$').match
+# how long to hold a wait request without changes
+WAIT_TIMEOUT = timedelta(minutes=5)
 
 
 class AuthenticationError(Exception):
@@ -42,35 +51,74 @@ def validate_positive_int(datum):
         raise ValueError
 
 
-def parse_pull_input(encoded):
-    json = loads(encoded)
+def validate_limit(datum):
+    validate_positive_int(datum)
+    if not datum:
+        raise ValueError
 
-    validate_in('offs', json)
-    validate_type(json['offs'], dict)
 
-    for app_id in json['offs']:
+def validate_offs(offs):
+    validate_type(offs, dict)
+
+    for app_id in offs:
+        validate_app_id(app_id)
+        validate_positive_int(offs[app_id])
+
+
+def validate_data(data):
+    validate_type(data, dict)
+
+    for app_id in data:
         validate_app_id(app_id)
-        validate_positive_int(json['offs'][app_id])
+        validate_type(data[app_id], list)
+        if not len(data[app_id]) == 2:
+            raise ValueError
+
+        validate_positive_int(data[app_id][0])
+        validate_type(data[app_id][1], basestring)
+        if not len(data[app_id][1]):
+            raise ValueError
+
+
+def parse_pull_input(encoded, content_type=JSON):
+    json = decode(encoded, content_type)
+    if is_framed(content_type) and (json['data'] or json['more']):
+        raise ValueError
+
+    validate_in('offs', json)
+    validate_offs(json['offs'])
+
+    if 'limit' in json:
+        validate_limit(json['limit'])
 
     return json
 
 
-def parse_push_input(encoded):
-    json = loads(encoded)
+def parse_push_input(encoded, content_type=JSON):
+    json = decode(encoded, content_type)
+    if is_framed(content_type) and (
+            json['offs'] or json['more'] or 'limit' in json):
+        raise ValueError
 
     validate_in('data', json)
-    validate_type(json['data'], dict)
+    validate_data(json['data'])
 
-    for app_id in json['data']:
-        validate_app_id(app_id)
-        validate_type(json['data'][app_id], list)
-        if not len(json['data'][app_id]) == 2:
-            raise ValueError
+    return json
 
-        validate_positive_int(json['data'][app_id][0])
-        validate_type(json['data'][app_id][1], basestring)
-        if not len(json['data'][app_id][1]):
-            raise ValueError
+
+def parse_sync_input(encoded, content_type=JSON):
+    json = decode(encoded, content_type)
+    if is_framed(content_type) and json['more']:
+        raise ValueError
+
+    validate_in('offs', json)
+    validate_offs(json['offs'])
+
+    json.setdefault('data', {})
+    validate_data(json['data'])
+
+    if 'limit' in json:
+        validate_limit(json['limit'])
 
     return json
 
@@ -81,55 +129,300 @@ def authenticate(data_dir, auth_token):
         raise AuthenticationError
 
 
+class OffsetCache(object):
+    """
+    Offsets of every user, so that a pull without anything new does not
+    list and stat the user's directory. The server is the only one
+    appending to the logs and updates the cache after every insert. An
+    entry is valid as long as the directory mtime is unchanged, which
+    catches logs created or removed behind the server's back. Offsets
+    read within MTIME_GRANULARITY of the mtime are not cached, a log
+    created in the same tick would not change it.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, path, mtime):
+        """
+        Return the cached offsets of path or None if they are missing or
+        older than mtime.
+        """
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != mtime:
+            self.stats['misses'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        return defaultdict(int, entry[1])
+
+    def put(self, path, mtime, offs):
+        if time.time() - mtime > MTIME_GRANULARITY:
+            self.entries[path] = (mtime, dict(offs))
+
+    def update(self, path, offs):
+        """
+        Take over offs after an insert. New logs change the directory
+        mtime, so the entry is dropped then and reloaded on the next get.
+        """
+        entry = self.entries.get(path)
+        if entry is not None and set(entry[1]) == set(offs):
+            self.entries[path] = (entry[0], dict(offs))
+        else:
+            self.invalidate(path)
+
+    def invalidate(self, path):
+        self.entries.pop(path, None)
+
+
 class BaseHandler(web.RequestHandler):
-    def initialize(self, args):
+    """
+    All disk access goes through the executor so that the IOLoop never
+    blocks on it. Offsets and writes of a user are serialized by a lock
+    per user. Data below the offsets never changes, so it can be read
+    without holding the lock.
+    """
+    def initialize(self, args, executor, user_locks, user_conditions,
+                   offset_cache):
         self.data_dir = args.data_dir
+        self.executor = executor
+        self.user_locks = user_locks
+        self.user_conditions = user_conditions
+        self.offset_cache = offset_cache
+
+    def run(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    @gen.coroutine
+    def get_offsets(self):
+        """
+        Return the offsets of the user, from the cache if possible. Needs
+        to be called with the user lock held.
+        """
+        path = self.db.data_path
+        # before listing so that later changes invalidate the entry
+        mtime = yield self.run(os.path.getmtime, path)
+        offs = self.offset_cache.get(path, mtime)
+        if offs is None:
+            offs = yield self.run(self.db.get_offsets)
+            self.offset_cache.put(path, mtime, offs)
+
+        raise gen.Return(offs)
+
+    @gen.coroutine
+    def insert_data(self, local_offs, remote_data):
+        """
+        Insert gapless remote data and return the new offsets. Needs to be
+        called with the user lock held.
+        """
+        try:
+            local_offs = yield self.run(
+                self.db.insert_data, local_offs, remote_data)
+        except Exception:
+            # partially written, reload from disk
+            self.offset_cache.invalidate(self.db.data_path)
+            raise
+
+        self.offset_cache.update(self.db.data_path, local_offs)
+        self.user_condition.notify_all()
+        raise gen.Return(local_offs)
 
     def process(self):
         raise NotImplemented
 
+    @gen.coroutine
     def post(self, auth_token):
         try:
-            authenticate(self.data_dir, auth_token)
+            yield self.run(authenticate, self.data_dir, auth_token)
             self.db = Database(os.path.join(self.data_dir, auth_token))
-            self.process()
+            self.user_lock = self.user_locks[auth_token]
+            self.user_condition = self.user_conditions[auth_token]
+            yield self.process()
         except AuthenticationError:
             self.send_error(401)
 
 
 class PullHandler(BaseHandler):
+    """
+    Send the data the client is missing. If the client gives a limit, send
+    about that many bytes at most and set "more" if there is data left,
+    which the client then pulls with its updated offsets. The response is
+    flushed after every app_id so that it never sits in memory as a whole.
+    It is JSON unless the client accepts one of the framed encodings.
+
+    The ETag of a response is the tag of the server's offsets. A client
+    sending the tag of its own offsets in If-None-Match gets a 304 and no
+    body if both sides have the same data.
+    """
+    parse_input = staticmethod(parse_pull_input)
+    # whether requests carry data to insert
+    pushes = False
+
+    @gen.coroutine
     def process(self):
-        local_offs = self.db.get_offsets()
         try:
-            remote = parse_pull_input(self.request.body)
-            remote_offs = defaultdict(int, remote['offs'])
-
-            self.write({
-                'offs': local_offs,
-                'data': self.db.get_missing_data(local_offs, remote_offs),
-            })
+            remote = self.parse_input(
+                self.request.body, self.request.headers.get('Content-Type'))
         except ValueError:
             self.send_error(400)
+            return
+
+        with (yield self.user_lock.acquire()):
+            local_offs = yield self.get_offsets()
+            if self.pushes and remote['data'] and \
+                    self.db.is_gapless(local_offs, remote['data']):
+                local_offs = yield self.insert_data(
+                    local_offs, remote['data'])
+
+        tag = offsets_tag(local_offs)
+        self.set_header('Etag', tag)
+        if matches_tag(self.request.headers.get('If-None-Match'), tag):
+            self.set_status(304)
+            return
+
+        remote_offs = defaultdict(int, remote['offs'])
+        missing = self.db.iter_missing_data(
+            local_offs, remote_offs, remote.get('limit'))
+        content_type = negotiate(self.request.headers.get('Accept'))
+
+        if content_type == JSON:
+            encoder = None
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+            self.write('{{"offs": {}, "data": {{'.format(dumps(local_offs)))
+        else:
+            encoder = Encoder(content_type)
+            self.set_header('Content-Type', content_type)
+            self.write(encoder.offsets(local_offs))
+
+        sep = ''
+        while True:
+            missing_data = yield self.run(next, missing, None)
+            if missing_data is None:
+                break
+
+            app_id, remote_off, data = missing_data
+            if encoder:
+                self.write(encoder.data(app_id, remote_off, data))
+            else:
+                self.write('{}{}: {}'.format(
+                    sep, dumps(app_id), dumps([remote_off, data])))
+                sep = ', '
+            yield self.flush()
+            remote_offs[app_id] = remote_off + len(data)
+
+        more = self.has_more(local_offs, remote_offs)
+        if encoder:
+            if more:
+                self.write(encoder.more())
+            self.write(encoder.finish())
+        else:
+            self.write('}}, "more": {}}}'.format(dumps(more)))
+
+    @staticmethod
+    def has_more(local_offs, remote_offs):
+        return any(
+            local_off > remote_offs[app_id]
+            for app_id, local_off in local_offs.iteritems())
 
 
 class PushHandler(BaseHandler):
+    @gen.coroutine
     def process(self):
         try:
-            remote = parse_push_input(self.request.body)
-            local_offs = self.db.get_offsets()
+            remote = parse_push_input(
+                self.request.body, self.request.headers.get('Content-Type'))
+        except ValueError:
+            self.send_error(400)
+            return
+
+        with (yield self.user_lock.acquire()):
+            local_offs = yield self.get_offsets()
             if not self.db.is_gapless(local_offs, remote['data']):
                 self.send_error(400)
             else:
-                self.db.insert_data(local_offs, remote['data'])
+                yield self.insert_data(local_offs, remote['data'])
                 self.write({})
-        except ValueError:
-            self.send_error(400)
+
+
+class SyncHandler(PullHandler):
+    """
+    Push and pull in a single round trip. The client's data is inserted
+    like a push if it is gapless and ignored otherwise. The response is
+    that of a pull, and the server's offsets in it tell the client whether
+    it still needs to push.
+    """
+    parse_input = staticmethod(parse_sync_input)
+    pushes = True
+
+
+class WaitHandler(BaseHandler):
+    """
+    Long-poll for changes. Respond as soon as the tag of the user's
+    offsets differs from the one in If-None-Match, which is right away if
+    it already does, or with a 304 after WAIT_TIMEOUT.
+    """
+    closed = False
+    # set once the user is authenticated
+    user_condition = None
+
+    def on_connection_close(self):
+        self.closed = True
+        # let the handler notice, the other waiters just wait again
+        if self.user_condition is not None:
+            self.user_condition.notify_all()
+
+    @gen.coroutine
+    def process(self):
+        deadline = ioloop.IOLoop.current().time() + \
+            WAIT_TIMEOUT.total_seconds()
+
+        while not self.closed:
+            with (yield self.user_lock.acquire()):
+                local_offs = yield self.get_offsets()
+
+            tag = offsets_tag(local_offs)
+            if not matches_tag(self.request.headers.get('If-None-Match'), tag):
+                self.set_header('Etag', tag)
+                self.write({})
+                return
+
+            # no yield since reading the offsets, so no push is missed
+            if not (yield self.user_condition.wait(deadline)):
+                self.set_status(304)
+                return
+
+
+class StatsHandler(BaseHandler):
+    """
+    Counters of the server, for any authenticated user.
+    """
+    @gen.coroutine
+    def get(self, auth_token):
+        try:
+            yield self.run(authenticate, self.data_dir, auth_token)
+        except AuthenticationError:
+            self.send_error(401)
+            return
+
+        self.write({'offset_cache': self.offset_cache.stats})
 
 
 def make_app(args):
+    kwargs = {
+        'args': args,
+        'executor': ThreadPoolExecutor(args.io_threads)
+        if args.io_threads else dummy_executor,
+        'user_locks': defaultdict(locks.Lock),
+        'user_conditions': defaultdict(locks.Condition),
+        'offset_cache': OffsetCache(),
+    }
+
     return web.Application([
-        (r'/gtd/([0-9a-zA-Z]{10})/pull', PullHandler, {'args': args}),
-        (r'/gtd/([0-9a-zA-Z]{10})/push', PushHandler, {'args': args}),
+        (r'/gtd/([0-9a-zA-Z]{10})/pull', PullHandler, kwargs),
+        (r'/gtd/([0-9a-zA-Z]{10})/push', PushHandler, kwargs),
+        (r'/gtd/([0-9a-zA-Z]{10})/sync', SyncHandler, kwargs),
+        (r'/gtd/([0-9a-zA-Z]{10})/wait', WaitHandler, kwargs),
+        (r'/gtd/([0-9a-zA-Z]{10})/stats', StatsHandler, kwargs),
     ])
 
 
@@ -147,6 +440,9 @@ def run():
     parser.add_argument('data_dir', help='path to data directory')
     parser.add_argument(
         '--no-syslog', '-S', action='store_true', help='no syslog logging')
+    parser.add_argument(
+        '--io-threads', type=int, default=4, help='number of threads doing '
+        'disk I/O, 0 to do it on the main thread')
     args = parser.parse_args()
 
     if not os.path.isdir(args.data_dir):
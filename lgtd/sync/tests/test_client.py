@@ -0,0 +1,111 @@
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import requests
+from mock import Mock
+
+from ...lib.db.syncable import Database
+from ..client import sync
+from ..wire import FRAMES_ZLIB, JSON, decode, encode
+
+CONFIG = {'host': 'localhost', 'port': 9002, 'sync_auth': 'abcdefghij'}
+
+
+def make_response(status_code, content_type=FRAMES_ZLIB, **message):
+    response = Mock(
+        status_code=status_code, headers={'Content-Type': content_type},
+        content=encode(content_type, **message) if message else '')
+    if status_code >= 400:
+        response.raise_for_status.side_effect = \
+            requests.exceptions.HTTPError(response=response)
+    return response
+
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'data')
+        self.lock_file = os.path.join(self.tmp_dir, 'lock')
+        os.mkdir(self.data_dir)
+        open(self.lock_file, 'w').close()
+        self.db = Database(self.data_dir, self.lock_file)
+        self.session = Mock()
+
+        with open(os.path.join(self.data_dir, 'ab'), 'w') as f:
+            f.write('a0\na1\n')
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def sent(self):
+        """
+        Return the endpoints and decoded bodies of the requests sent.
+        """
+        return [
+            (args[0].rsplit('/', 1)[1],
+             decode(kwargs['data'], kwargs['headers']['Content-Type']))
+            for args, kwargs in self.session.post.call_args_list]
+
+    def test_not_modified(self):
+        self.session.post.side_effect = [make_response(304)]
+        self.assertEqual(
+            sync(CONFIG, self.db, self.session, {'ab': 6}), {'ab': 6})
+        self.assertEqual([op for op, _ in self.sent()], ['sync'])
+
+    def test_pages(self):
+        self.session.post.side_effect = [
+            make_response(
+                200, offs={'ab': 6, 'cd': 6}, data={'cd': [0, 'c0\n']},
+                more=True),
+            make_response(
+                200, JSON, offs={'ab': 6, 'cd': 6}, data={'cd': [3, 'c1\n']}),
+        ]
+
+        self.assertEqual(
+            sync(CONFIG, self.db, self.session, {'ab': 6}),
+            {'ab': 6, 'cd': 6})
+        ops = self.sent()
+        self.assertEqual([op for op, _ in ops], ['sync', 'pull'])
+        self.assertEqual(ops[1][1]['offs'], {'ab': 6, 'cd': 3})
+        with open(os.path.join(self.data_dir, 'cd')) as f:
+            self.assertEqual(f.read(), 'c0\nc1\n')
+
+    def test_stale_server_offs(self):
+        # the server lost a1 since the last sync
+        self.session.post.side_effect = [
+            make_response(200, offs={'ab': 3}, data={}),
+            make_response(200),
+        ]
+
+        self.assertEqual(
+            sync(CONFIG, self.db, self.session, {'ab': 6}), {'ab': 6})
+        ops = self.sent()
+        self.assertEqual([op for op, _ in ops], ['sync', 'push'])
+        self.assertEqual(ops[0][1]['data'], {})
+        self.assertEqual(ops[1][1]['data'], {'ab': [3, 'a1\n']})
+
+    def test_no_sync_endpoint(self):
+        unsupported = set()
+        self.session.post.side_effect = [
+            make_response(404),
+            make_response(200, JSON, offs={}, data={}),
+            make_response(200, JSON),
+        ]
+
+        self.assertEqual(
+            sync(CONFIG, self.db, self.session, None, unsupported),
+            {'ab': 6})
+        self.assertEqual(unsupported, set(['sync']))
+        ops = self.sent()
+        self.assertEqual([op for op, _ in ops], ['sync', 'pull', 'push'])
+        self.assertEqual(ops[2][1]['data'], {'ab': [0, 'a0\na1\n']})
+
+        # not asked again
+        self.session.post.reset_mock()
+        self.session.post.side_effect = [make_response(304, JSON)]
+        self.assertEqual(
+            sync(CONFIG, self.db, self.session, {'ab': 6}, unsupported),
+            {'ab': 6})
+        self.assertEqual([op for op, _ in self.sent()], ['pull'])
@@ -1,7 +1,23 @@
+import os
+import time
 import unittest
-from json import dumps
+from argparse import Namespace
+from datetime import timedelta
+from json import dumps, loads
+from shutil import rmtree
+from tempfile import mkdtemp
 
-from ..server import parse_pull_input, parse_push_input
+from mock import Mock, patch
+from tornado import gen
+from tornado.httputil import HTTPServerRequest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from .. import server
+from ..server import (OffsetCache, make_app, parse_pull_input,
+                      parse_push_input, parse_sync_input)
+from ..wire import FRAMES, FRAMES_ZLIB, decode, encode, offsets_tag
+
+TOKEN = 'abcdefghij'
 
 
 class ServerTestCase(unittest.TestCase):
@@ -21,6 +37,12 @@ class ServerTestCase(unittest.TestCase):
         }
         self.assertEqual(parse_pull_input(dumps(good)), good)
 
+        good = {
+            'offs': {},
+            'limit': 1024,
+        }
+        self.assertEqual(parse_pull_input(dumps(good)), good)
+
     def test_parse_pull_bad(self):
         bads = [{  # empty
             }, {
@@ -37,6 +59,12 @@ class ServerTestCase(unittest.TestCase):
                 'offs': {
                     'ab': -38,  # value not in range
                 },
+            }, {
+                'offs': {},
+                'limit': 0,  # limit not in range
+            }, {
+                'offs': {},
+                'limit': '1024',  # wrong type of limit
             },
         ]
 
@@ -53,6 +81,37 @@ class ServerTestCase(unittest.TestCase):
         }
         self.assertEqual(parse_push_input(dumps(good)), good)
 
+    def test_parse_framed(self):
+        offs = {'00': 190582, 'ab': 1}
+        data = {'ab': [102, 'abc abc ...']}
+
+        self.assertEqual(
+            parse_pull_input(encode(FRAMES, offs=offs, limit=10), FRAMES),
+            {'offs': offs, 'limit': 10, 'data': {}, 'more': False})
+        self.assertEqual(
+            parse_push_input(encode(FRAMES_ZLIB, data=data), FRAMES_ZLIB),
+            {'offs': {}, 'data': data, 'more': False})
+
+        bads = [
+            encode(FRAMES, offs={'a$': 1}),  # invalid app_id
+            encode(FRAMES, offs=offs, limit=0),  # limit not in range
+            encode(FRAMES, offs=offs, data=data),  # data in pull
+            encode(FRAMES, more=True),  # more in pull
+        ]
+        for bad in bads:
+            with self.assertRaises(ValueError):
+                parse_pull_input(bad, FRAMES)
+
+        bads = [
+            encode(FRAMES, data={'a$': [1, 'abc']}),  # invalid app_id
+            encode(FRAMES, data={'Qa': [1, '']}),  # invalid empty string
+            encode(FRAMES, data=data, offs=offs),  # offs in push
+            encode(FRAMES, data=data, limit=10),  # limit in push
+        ]
+        for bad in bads:
+            with self.assertRaises(ValueError):
+                parse_push_input(bad, FRAMES)
+
     def test_parse_push_bad(self):
         bads = [{  # empty
             }, {
@@ -87,3 +146,255 @@ class ServerTestCase(unittest.TestCase):
         for bad in bads:
             with self.assertRaises(ValueError):
                 parse_push_input(dumps(bad))
+
+    def test_parse_sync(self):
+        self.assertEqual(parse_sync_input(dumps({'offs': {'ab': 4}})), {
+            'offs': {'ab': 4},
+            'data': {},
+        })
+        self.assertEqual(
+            parse_sync_input(encode(
+                FRAMES, offs={'ab': 4}, limit=8, data={'Qi': [0, 'baz\n']}),
+                FRAMES)['data'],
+            {'Qi': [0, 'baz\n']})
+
+        for bad in [
+            {'data': {}},
+            {'offs': {}, 'data': {'Qi': [0, '']}},
+            {'offs': {}, 'limit': 0},
+        ]:
+            self.assertRaises(ValueError, parse_sync_input, dumps(bad))
+
+        self.assertRaises(
+            ValueError, parse_sync_input,
+            encode(FRAMES, offs={'ab': 4}, more=True), FRAMES)
+
+    def test_offset_cache(self):
+        cache = OffsetCache()
+        self.assertIsNone(cache.get('a', 1.0))
+
+        # too recent to rely on the mtime
+        cache.put('b', time.time(), {'ab': 4})
+        self.assertEqual(cache.entries, {})
+
+        cache.put('a', 1.0, {'ab': 4})
+        self.assertEqual(cache.get('a', 1.0), {'ab': 4})
+        self.assertEqual(cache.get('a', 1.0)['Qi'], 0)
+        self.assertIsNone(cache.get('a', 2.0))
+
+        cache.update('a', {'ab': 8})
+        self.assertEqual(cache.get('a', 1.0), {'ab': 8})
+
+        # a new log changes the mtime
+        cache.update('a', {'ab': 8, 'Qi': 4})
+        self.assertIsNone(cache.get('a', 1.0))
+
+        self.assertEqual(cache.stats, {'hits': 3, 'misses': 3})
+
+
+class PullTestCase(AsyncHTTPTestCase):
+    def setUp(self):
+        self.data_dir = mkdtemp()
+        os.mkdir(os.path.join(self.data_dir, TOKEN))
+        super(PullTestCase, self).setUp()
+
+    def tearDown(self):
+        super(PullTestCase, self).tearDown()
+        rmtree(self.data_dir)
+
+    def get_app(self):
+        return make_app(Namespace(data_dir=self.data_dir, io_threads=2))
+
+    def write_log(self, app_id, data):
+        with open(os.path.join(self.data_dir, TOKEN, app_id), 'w') as f:
+            f.write(data)
+
+    def pull(self, body):
+        response = self.fetch(
+            '/gtd/{}/pull'.format(TOKEN), method='POST', body=dumps(body))
+        self.assertEqual(response.code, 200)
+        return loads(response.body)
+
+    def test_pull(self):
+        self.write_log('ab', 'foo\nbar\n')
+        self.write_log('Qi', 'baz\n')
+
+        self.assertEqual(self.pull({'offs': {'ab': 4}}), {
+            'offs': {'ab': 8, 'Qi': 4},
+            'data': {'ab': [4, 'bar\n'], 'Qi': [0, 'baz\n']},
+            'more': False,
+        })
+
+    def test_pull_pages(self):
+        self.write_log('ab', 'foo\nbar\n')
+        self.write_log('Qi', 'baz\n')
+
+        remote = self.pull({'offs': {}, 'limit': 6})
+        self.assertEqual(
+            remote['data'], {'ab': [0, 'foo\n'], 'Qi': [0, 'baz\n']})
+        self.assertTrue(remote['more'])
+
+        remote = self.pull({'offs': {'ab': 4, 'Qi': 4}, 'limit': 6})
+        self.assertEqual(remote['data'], {'ab': [4, 'bar\n']})
+        self.assertFalse(remote['more'])
+
+        response = self.fetch(
+            '/gtd/{}/pull'.format(TOKEN), method='POST',
+            body=dumps({'offs': {}, 'limit': 0}))
+        self.assertEqual(response.code, 400)
+
+    def test_unknown_token(self):
+        response = self.fetch(
+            '/gtd/0123456789/pull', method='POST', body=dumps({'offs': {}}))
+        self.assertEqual(response.code, 401)
+
+    def test_push(self):
+        self.write_log('ab', 'foo\n')
+
+        def push(data):
+            return self.fetch(
+                '/gtd/{}/push'.format(TOKEN), method='POST',
+                body=dumps({'data': data}))
+
+        self.assertEqual(push({'ab': [0, 'foo\nbar\n']}).code, 200)
+        self.assertEqual(push({'Qi': [0, 'baz\n']}).code, 200)
+        self.assertEqual(push({'Qi': [8, 'gap\n']}).code, 400)
+
+        self.assertEqual(self.pull({'offs': {}})['data'], {
+            'ab': [0, 'foo\nbar\n'],
+            'Qi': [0, 'baz\n'],
+        })
+
+    def test_pull_cached(self):
+        self.write_log('ab', 'foo\n')
+        os.utime(os.path.join(self.data_dir, TOKEN), (1, 1))
+
+        def stats():
+            return loads(self.fetch(
+                '/gtd/{}/stats'.format(TOKEN)).body)['offset_cache']
+
+        self.assertEqual(self.fetch('/stats').code, 404)
+        self.assertEqual(self.fetch('/gtd/0123456789/stats').code, 401)
+
+        self.assertEqual(self.pull({'offs': {}})['offs'], {'ab': 4})
+        self.assertEqual(self.pull({'offs': {}})['offs'], {'ab': 4})
+        self.assertEqual(stats(), {'hits': 1, 'misses': 1})
+
+        response = self.fetch(
+            '/gtd/{}/push'.format(TOKEN), method='POST',
+            body=dumps({'data': {'ab': [4, 'bar\n']}}))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.pull({'offs': {'ab': 4}})['data'], {
+            'ab': [4, 'bar\n'],
+        })
+        self.assertEqual(stats(), {'hits': 3, 'misses': 1})
+
+        # created behind the server's back
+        self.write_log('Qi', 'baz\n')
+        os.utime(os.path.join(self.data_dir, TOKEN), (0, 0))
+        self.assertEqual(
+            self.pull({'offs': {}})['offs'], {'ab': 8, 'Qi': 4})
+        self.assertEqual(stats(), {'hits': 3, 'misses': 2})
+
+    def test_pull_not_modified(self):
+        self.write_log('ab', 'foo\n')
+
+        def pull(offs):
+            return self.fetch(
+                '/gtd/{}/pull'.format(TOKEN), method='POST',
+                body=dumps({'offs': offs}),
+                headers={'If-None-Match': offsets_tag(offs)})
+
+        response = pull({'ab': 4})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, '')
+
+        response = pull({})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Etag'], offsets_tag({'ab': 4}))
+        self.assertEqual(loads(response.body)['data'], {'ab': [0, 'foo\n']})
+
+    @gen_test
+    def test_wait(self):
+        self.write_log('ab', 'foo\n')
+
+        def wait(offs):
+            return self.http_client.fetch(
+                self.get_url('/gtd/{}/wait'.format(TOKEN)), method='POST',
+                body='', headers={'If-None-Match': offsets_tag(offs)},
+                raise_error=False)
+
+        # changed already
+        response = yield wait({})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Etag'], offsets_tag({'ab': 4}))
+
+        waiting = wait({'ab': 4})
+        yield gen.sleep(0.05)
+        self.assertFalse(waiting.done())
+
+        response = yield self.http_client.fetch(
+            self.get_url('/gtd/{}/push'.format(TOKEN)), method='POST',
+            body=dumps({'data': {'ab': [4, 'bar\n']}}))
+        self.assertEqual(response.code, 200)
+
+        response = yield waiting
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Etag'], offsets_tag({'ab': 8}))
+
+        with patch.object(server, 'WAIT_TIMEOUT', timedelta(seconds=0.05)):
+            response = yield wait({'ab': 8})
+        self.assertEqual(response.code, 304)
+
+    def test_wait_closed_early(self):
+        # before authenticate() returned from the executor
+        handler = server.WaitHandler(
+            self._app, HTTPServerRequest('POST', '/', connection=Mock()),
+            args=Namespace(data_dir=self.data_dir), executor=None,
+            user_locks={}, user_conditions={}, offset_cache=OffsetCache())
+        handler.on_connection_close()
+        self.assertTrue(handler.closed)
+
+    def test_sync(self):
+        self.write_log('ab', 'foo\n')
+        self.write_log('Qi', 'baz\n')
+
+        def sync(body, content_type=None):
+            response = self.fetch(
+                '/gtd/{}/sync'.format(TOKEN), method='POST', body=body,
+                headers={'Content-Type': content_type or 'application/json'})
+            self.assertEqual(response.code, 200)
+            return loads(response.body)
+
+        remote = sync(dumps({
+            'offs': {'ab': 4, 'xy': 4},
+            'data': {'xy': [0, 'new\n']},
+        }))
+        self.assertEqual(remote, {
+            'offs': {'ab': 4, 'Qi': 4, 'xy': 4},
+            'data': {'Qi': [0, 'baz\n']},
+            'more': False,
+        })
+
+        # gaps are ignored, the offsets tell the client
+        remote = sync(encode(FRAMES, offs={'ab': 4, 'Qi': 4}, data={
+            'ab': [8, 'gap\n'],
+        }), FRAMES)
+        self.assertEqual(remote['offs'], {'ab': 4, 'Qi': 4, 'xy': 4})
+        self.assertEqual(remote['data'], {'xy': [0, 'new\n']})
+
+    def test_pull_framed(self):
+        self.write_log('ab', 'foo\nbar\n')
+
+        response = self.fetch(
+            '/gtd/{}/pull'.format(TOKEN), method='POST',
+            body=encode(FRAMES, offs={'ab': 4}, limit=1), headers={
+                'Content-Type': FRAMES,
+                'Accept': '{}, application/json'.format(FRAMES_ZLIB),
+            })
+        self.assertEqual(response.headers['Content-Type'], FRAMES_ZLIB)
+        self.assertEqual(decode(response.body, FRAMES_ZLIB), {
+            'offs': {'ab': 8},
+            'data': {'ab': [4, 'bar\n']},
+            'more': False,
+        })
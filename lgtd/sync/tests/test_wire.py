@@ -0,0 +1,73 @@
+import unittest
+import zlib
+
+from ..wire import (FRAMES, FRAMES_ZLIB, JSON, Encoder, decode, encode,
+                    matches_tag, negotiate, offsets_tag)
+
+
+class WireTestCase(unittest.TestCase):
+    def test_negotiate(self):
+        self.assertEqual(negotiate(None), JSON)
+        self.assertEqual(negotiate('*/*'), JSON)
+        self.assertEqual(negotiate('text/html, {}'.format(FRAMES)), FRAMES)
+        self.assertEqual(negotiate('{}; q=1, {}'.format(
+            FRAMES_ZLIB, JSON)), FRAMES_ZLIB)
+
+    def test_offsets_tag(self):
+        tag = offsets_tag({'ab': 4, 'Qi': 8})
+        self.assertEqual(tag, offsets_tag({'Qi': 8, 'ab': 4, 'xy': 0}))
+        self.assertNotEqual(tag, offsets_tag({'ab': 4, 'Qi': 9}))
+        self.assertNotEqual(tag, offsets_tag({'ab': 4}))
+
+        self.assertTrue(matches_tag(tag, tag))
+        self.assertTrue(matches_tag('"foo", W/{}'.format(tag), tag))
+        self.assertFalse(matches_tag('"foo"', tag))
+        self.assertFalse(matches_tag(None, tag))
+
+    def test_round_trip(self):
+        offs = {'ab': 12, 'Q8': 0}
+        data = {'ab': [0, 'abc abc\n'], 'Q8': [1 << 40, 'foo\n']}
+
+        for content_type in (FRAMES, FRAMES_ZLIB):
+            self.assertEqual(decode(encode(
+                content_type, offs=offs, limit=1024), content_type), {
+                    'offs': offs, 'data': {}, 'more': False, 'limit': 1024})
+            self.assertEqual(decode(encode(
+                content_type, data=data, more=True), content_type), {
+                    'offs': {}, 'data': data, 'more': True})
+
+        self.assertEqual(
+            decode(encode(JSON, offs=offs), 'application/json; charset=x'),
+            {'offs': offs})
+
+    def test_streaming(self):
+        encoder = Encoder(FRAMES_ZLIB)
+        encoded = encoder.offsets({'ab': 4})
+        chunk = encoder.data('ab', 0, 'foo\n')
+        # every chunk can be decompressed on its own arrival
+        self.assertEqual(
+            zlib.decompressobj().decompress(encoded + chunk)[-4:], 'foo\n')
+        encoded += chunk + encoder.finish()
+
+        self.assertEqual(decode(encoded, FRAMES_ZLIB), {
+            'offs': {'ab': 4}, 'data': {'ab': [0, 'foo\n']}, 'more': False})
+
+    def test_bad(self):
+        good = encode(FRAMES, offs={'ab': 1}, data={'ab': [0, 'foo']})
+        bads = [
+            good[:-1],  # truncated data
+            good[:5],  # truncated record
+            good + 'X',  # unknown record
+            good + good,  # duplicate app_ids
+            'MM',  # duplicate flag
+        ]
+
+        for bad in bads:
+            with self.assertRaises(ValueError):
+                decode(bad, FRAMES)
+
+        with self.assertRaises(ValueError):
+            decode(good, FRAMES_ZLIB)
+
+        with self.assertRaises(ValueError):
+            decode(zlib.compress('\0' * 1024), FRAMES_ZLIB)
@@ -0,0 +1,215 @@
+"""
+Encodings of sync messages. JSON is what every client and server speaks,
+the framed encodings are negotiated through Content-Type and Accept.
+
+A framed message is a sequence of records, each starting with a type byte:
+
+    'O' app_id offset                   offset of an app_id
+    'L' limit                           byte budget of a pull
+    'D' app_id offset length data       data of an app_id
+    'M'                                 more data is available
+
+app_ids take APP_ID_LEN bytes, offsets and limits are unsigned 64 bit and
+lengths unsigned 32 bit integers in network byte order. With the +zlib
+variant the whole sequence is zlib compressed.
+"""
+import zlib
+from hashlib import sha1
+from json import dumps, loads
+from struct import Struct, error
+
+from ..lib.constants import APP_ID_LEN
+
+JSON = 'application/json'
+FRAMES = 'application/vnd.lgtd.frames'
+FRAMES_ZLIB = 'application/vnd.lgtd.frames+zlib'
+# in order of preference
+CONTENT_TYPES = (FRAMES_ZLIB, FRAMES, JSON)
+
+# upper bound for decompressed messages
+MAX_MESSAGE_SIZE = 256 << 20
+
+OFFSET = Struct('>{}sQ'.format(APP_ID_LEN))
+LIMIT = Struct('>Q')
+DATA = Struct('>{}sQI'.format(APP_ID_LEN))
+
+
+def media_type(header):
+    """
+    Return the media type of a Content-Type header without parameters.
+    """
+    return (header or JSON).split(';')[0].strip().lower()
+
+
+def is_framed(content_type):
+    return media_type(content_type) in (FRAMES, FRAMES_ZLIB)
+
+
+def offsets_tag(offs):
+    """
+    Return an entity tag of an offset vector. Empty logs do not count, so
+    that both sides agree on it whenever they have the same data.
+    """
+    digest = sha1()
+    for app_id, offset in sorted(offs.iteritems()):
+        if offset:
+            digest.update('{}:{}\n'.format(app_id, offset))
+
+    return '"{}"'.format(digest.hexdigest())
+
+
+def matches_tag(if_none_match, tag):
+    """
+    Return true if an If-None-Match header contains tag.
+    """
+    return any(
+        candidate.strip() in (tag, 'W/' + tag)
+        for candidate in (if_none_match or '').split(','))
+
+
+def negotiate(accept):
+    """
+    Pick the content type to respond with given an Accept header, in the
+    client's order of preference. Falls back to JSON.
+    """
+    for accepted in (accept or '').split(','):
+        if media_type(accepted) in CONTENT_TYPES:
+            return media_type(accepted)
+
+    return JSON
+
+
+class Encoder(object):
+    """
+    Encode a message piece by piece so that it can be streamed.
+    """
+    def __init__(self, content_type):
+        self.content_type = content_type
+        self.compressor = zlib.compressobj() \
+            if content_type == FRAMES_ZLIB else None
+
+    def _encode(self, chunk):
+        if self.compressor:
+            return self.compressor.compress(chunk) + \
+                self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return chunk
+
+    @staticmethod
+    def _app_id(app_id):
+        # struct would silently pad or cut it
+        if len(app_id) != APP_ID_LEN:
+            raise ValueError('invalid app_id')
+        return str(app_id)
+
+    def offsets(self, offs):
+        return self._encode(''.join(
+            'O' + OFFSET.pack(self._app_id(app_id), offset)
+            for app_id, offset in sorted(offs.iteritems())))
+
+    def limit(self, limit):
+        return self._encode('L' + LIMIT.pack(limit))
+
+    def data(self, app_id, offset, data):
+        return self._encode(
+            'D' + DATA.pack(self._app_id(app_id), offset, len(data)) + data)
+
+    def more(self):
+        return self._encode('M')
+
+    def finish(self):
+        return self.compressor.flush() if self.compressor else ''
+
+
+def encode(content_type, offs=None, limit=None, data=None, more=False):
+    """
+    Encode a whole message in the given content type.
+    """
+    if content_type == JSON:
+        message = {}
+        if offs is not None:
+            message['offs'] = offs
+        if limit is not None:
+            message['limit'] = limit
+        if data is not None:
+            message['data'] = data
+        if more:
+            message['more'] = more
+        return dumps(message)
+
+    encoder = Encoder(content_type)
+    chunks = []
+    if offs:
+        chunks.append(encoder.offsets(offs))
+    if limit is not None:
+        chunks.append(encoder.limit(limit))
+    for app_id, (offset, app_data) in sorted((data or {}).iteritems()):
+        chunks.append(encoder.data(app_id, offset, str(app_data)))
+    if more:
+        chunks.append(encoder.more())
+    chunks.append(encoder.finish())
+
+    return ''.join(chunks)
+
+
+def _decompress(encoded):
+    decompressor = zlib.decompressobj()
+    try:
+        decoded = decompressor.decompress(encoded, MAX_MESSAGE_SIZE)
+    except zlib.error:
+        raise ValueError('malformed compressed message')
+
+    if decompressor.unconsumed_tail:
+        raise ValueError('message too large')
+
+    return decoded
+
+
+def _decode_frames(encoded):
+    message = {'offs': {}, 'data': {}, 'more': False}
+    pos = 0
+
+    try:
+        while pos < len(encoded):
+            record, pos = encoded[pos], pos + 1
+            if record == 'O':
+                app_id, offset = OFFSET.unpack_from(encoded, pos)
+                pos += OFFSET.size
+                if app_id in message['offs']:
+                    raise ValueError('duplicate app_id')
+                message['offs'][app_id] = int(offset)
+            elif record == 'L' and 'limit' not in message:
+                message['limit'] = int(LIMIT.unpack_from(encoded, pos)[0])
+                pos += LIMIT.size
+            elif record == 'D':
+                app_id, offset, length = DATA.unpack_from(encoded, pos)
+                pos += DATA.size
+                if app_id in message['data'] or pos + length > len(encoded):
+                    raise ValueError('malformed data record')
+                message['data'][app_id] = [
+                    int(offset), encoded[pos:pos + length]]
+                pos += length
+            elif record == 'M' and not message['more']:
+                message['more'] = True
+            else:
+                raise ValueError('unexpected record')
+    except error:
+        raise ValueError('truncated record')
+
+    return message
+
+
+def decode(encoded, content_type):
+    """
+    Decode a message. JSON messages come back as they are, framed ones
+    always have offs, data and more and have limit if present. Raises
+    ValueError on malformed input.
+    """
+    content_type = media_type(content_type)
+
+    # anything unknown is JSON, old clients do not set a content type
+    if content_type == FRAMES_ZLIB:
+        return _decode_frames(_decompress(encoded))
+    elif content_type == FRAMES:
+        return _decode_frames(encoded)
+    else:
+        return loads(encoded)
@@ -1,6 +1,7 @@
 from argparse import ArgumentParser
 from collections import defaultdict
 from getpass import getpass
+from itertools import izip, tee
 from sys import exit, stderr, stdin, stdout
 
 from cryptography.exceptions import InvalidTag
@@ -21,6 +22,9 @@ def parse_args():
     dump_parser.add_argument(
         '-t', '--time', help='display extracted IV time as well',
         action='store_true')
+    dump_parser.add_argument(
+        '-j', '--jobs', help='number of processes to decrypt with',
+        type=int, default=1)
     dump_parser.set_defaults(func=dump)
 
     encrypt_parser = subparsers.add_parser('encrypt')
@@ -56,24 +60,31 @@ def get_keys():
 
 def dump(args):
     keys = get_keys()
+    ciphers = map(CommandCipher, keys)
     db = Database(args.data_dir)
 
-    for line, app_id, offset in db.read_all(defaultdict(int)):
-        decrypted = False
-        for key in keys:
-            cipher = CommandCipher(key)
-            try:
-                if args.time:
-                    time = CommandCipher.extract_time(line)
-                    stdout.write('{:.3f} '.format(time))
-                plaintext = cipher.decrypt(line, app_id, offset)
-                stdout.write(plaintext)
-                stdout.write('\n')
-                decrypted = True
-            except InvalidTag:
-                pass
-
-        if not decrypted and not args.force:
+    # the first key does the bulk of the work, the others are only tried
+    # on lines it cannot decrypt
+    records, to_decrypt = tee(db.read_all(defaultdict(int)))
+    plaintexts = ciphers[0].decrypt_parallel(
+        to_decrypt, args.jobs, strict=False)
+
+    for (line, app_id, offset), plaintext in izip(records, plaintexts):
+        if plaintext is None:
+            for cipher in ciphers[1:]:
+                try:
+                    plaintext = cipher.decrypt(line, app_id, offset)
+                    break
+                except InvalidTag:
+                    pass
+
+        if plaintext is not None:
+            if args.time:
+                time = CommandCipher.extract_time(line)
+                stdout.write('{:.3f} '.format(time))
+            stdout.write(plaintext)
+            stdout.write('\n')
+        elif not args.force:
             stdout.write('\n')
             stderr.write('unable to decrypt command with any password!\n')
             stderr.write('use --force to ignore this problem\n')
@@ -18,7 +18,7 @@ class PreviousTag(Intent):
         if context.vars['active_tag'] != active:
             context.vars['active_item'] = 0
             context.vars['active_tag'] = active
-            context.adapter.request_state(
+            context.request_state(
                 context.model['tags'][active]['name'])
 
 
@@ -32,7 +32,7 @@ class NextTag(Intent):
         if context.vars['active_tag'] != active:
             context.vars['active_item'] = 0
             context.vars['active_tag'] = active
-            context.adapter.request_state(
+            context.request_state(
                 context.model['tags'][active]['name'])
 
 
@@ -131,7 +131,7 @@ class SelectTag(Intent):
         if n < len(context.model['tags']) and n != context.vars['active_tag']:
             context.vars['active_tag'] = n
             context.vars['active_item'] = 0
-            context.adapter.request_state(context.model['tags'][n]['name'])
+            context.request_state(context.model['tags'][n]['name'])
 
 
 class Help(Intent):
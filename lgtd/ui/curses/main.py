@@ -44,6 +44,7 @@ class ModelStateAdapter(Thread):
         self.socket.send(dumps({
             'msg': 'auth_response',
             'mac': mac,
+            'features': ['delta'],
         }))
 
     def request_state(self, active_tag):
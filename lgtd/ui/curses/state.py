@@ -4,7 +4,8 @@ from curses import KEY_BACKSPACE
 from . import intent
 from ...lib import commands
 from ...lib.constants import ITEM_ID_LEN, KEY_ENTER, KEY_ESC
-from ...lib.util import ParseError, parse_natural_date, random_string
+from ...lib.util import (ParseError, parse_natural_date, patch_state,
+                         random_string)
 
 
 class Context(object):
@@ -18,27 +19,50 @@ class Context(object):
             'scroll_offset_tags': 0,
             'scroll_offset_items': 0,
         }
+        # state requests without a reply yet
+        self.pending_states = 0
 
     def set_state(self, state):
         self.state = state
 
+    def request_state(self, tag):
+        self.pending_states += 1
+        self.adapter.request_state(tag)
+
     def handle_input(self, char):
         return self.state.handle_input(self, char)
 
     def handle_data(self, data):
         if data['msg'] == 'auth_challenge':
             self.adapter.authenticate(self.adapter.key, data['nonce'])
-            self.adapter.request_state(
+            self.request_state(
                 self.model['tags'][self.vars['active_tag']]['name'])
         elif data['msg'] == 'new_state':
-            self.adapter.request_state(
+            self.request_state(
                 self.model['tags'][self.vars['active_tag']]['name'])
         elif data['msg'] == 'state':
+            self.pending_states = max(0, self.pending_states - 1)
             self.model = {
                 'tags': data['state']['tags'],
                 'items': data['state']['items'],
             }
             self.vars['active_tag'] = data['state']['active_tag']
+        elif data['msg'] == 'state_delta':
+            # the delta is against the server's view before our request,
+            # which may be of another tag, the reply brings the new state
+            if self.pending_states:
+                return
+
+            state = patch_state({
+                'tags': self.model['tags'],
+                'items': self.model['items'],
+                'active_tag': self.vars['active_tag'],
+            }, data['delta'])
+            self.model = {
+                'tags': state['tags'],
+                'items': state['items'],
+            }
+            self.vars['active_tag'] = state['active_tag']
 
 
 class State(object):
@@ -8,14 +8,15 @@ setup(
     author='Paul Baecher',
     author_email='pbaecher@gmail.com',
     url='https://github.com/pb-/lgtd-core',
-    packages=find_packages('.'),
+    packages=find_packages('.', exclude=['benchmarks']),
     license='GPLv3',
     install_requires=[
+        'futures >=3.0,<4',
         'tornado >=4.3,<5',
     ],
     extras_require={
         'client': [
-            'cryptography >=1.2.1,<3',
+            'cryptography >=2.0,<3',
             'pyinotify >=0.9.6,<1',
             'python-dateutil >=2.6.1,<3',
             'requests >=2.9.1,<3',